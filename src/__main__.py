@@ -6,8 +6,36 @@ import os.path as osp
 from . import swamp
 from . import cli_argparse
 from . import logger
+from . import cache
+from . import batch
+
+def cache_main(args):
+    clargs = cli_argparse.process_cache_cmd_line_args(args)
+
+    if clargs.cache_dir:
+        os.environ['RUBY_ASSESS_CACHE_DIR'] = osp.realpath(clargs.cache_dir)
+
+    sys.exit(cache.main(clargs))
+
+def batch_main(args):
+    clargs = cli_argparse.process_batch_cmd_line_args(args)
+
+    if not osp.isdir(clargs.work_dir):
+        os.makedirs(clargs.work_dir, exist_ok=True)
+
+    logger.init(clargs.work_dir)
+
+    try:
+        sys.exit(batch.main(clargs))
+    finally:
+        logger.shutdown()
 
 def main():
+    if sys.argv[1:2] == ['cache']:
+        cache_main(sys.argv[2:])
+    elif sys.argv[1:2] == ['batch']:
+        batch_main(sys.argv[2:])
+
     clargs = cli_argparse.process_cmd_line_args()
 
     if not osp.isdir(clargs.output_dir):
@@ -29,7 +57,8 @@ def main():
                                osp.realpath(clargs.output_dir),
                                osp.realpath(clargs.build_dir),
                                osp.realpath(clargs.tool_dir),
-                               osp.realpath(clargs.results_dir))
+                               osp.realpath(clargs.results_dir),
+                               clargs.jobs)
         sys.exit(exit_code)
     finally:
         logger.shutdown()
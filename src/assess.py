@@ -1,16 +1,18 @@
 import os
 import re
+import math
 import uuid
-import shutil
 import logging
 import os.path as osp
 import xml.etree.ElementTree as ET
-import subprocess
 
 from . import gencmd
 from . import utillib
 from . import confreader
+from . import cache
 from .logger import LogTaskStatus
+from .rubyenv import RubyEnv
+from .gemhome import GemHomeSnapshot, get_installed_gems, lock_gem_dirs
 from .utillib import UnpackArchiveError
 
 
@@ -81,7 +83,7 @@ class BuildArtifactsHelper:
                 if(elem.tag not in ['package-conf',
                                     'command', 'build-artifacts',
                                     'gem-install', 'gem-unpack',
-                                    'build-command'])}
+                                    'build-command', 'environments'])}
 
     def __init__(self, build_summary_file):
 
@@ -138,13 +140,20 @@ class BuildArtifactsHelper:
 
 
 class AssessmentSummary:
+    '''Writes assessment_summary.xml as the assessments are added, each
+    element is appended to the file when it is complete so that memory use
+    does not grow with the number of assessments and an interrupted run
+    leaves the summary of the assessments done so far. The environments
+    of the commands are written last, unless the layout is inline'''
 
     def __init__(self,
                  filename,
                  build_artifacts_helper,
-                 tool_conf):
+                 tool_conf,
+                 env_layout=utillib.EnvironmentTable.INLINE):
 
         self._filename = filename
+        self._env_table = utillib.EnvironmentTable(env_layout)
 
         ## keep the same name as other frameworks for consistency
         ## why ruby-assess is wildly different is ??
@@ -181,7 +190,14 @@ class AssessmentSummary:
         AssessmentSummary._add(self._root, 'tool-version', tool_conf['tool-version'])
         AssessmentSummary._add(self._root, 'platform-name', utillib.platform())
         AssessmentSummary._add(self._root, 'start-ts', utillib.posix_epoch())
-        self._assessment_artifacts = AssessmentSummary._add(self._root, 'assessment-artifacts')
+
+        self._fobj = open(self._filename, 'w', encoding='utf-8')
+        self._fobj.write("<?xml version='1.0' encoding='UTF-8'?>\n")
+        self._fobj.write('<assessment-summary>')
+        for elem in self._root:
+            self._fobj.write(ET.tostring(elem, encoding='unicode'))
+        self._fobj.write('<assessment-artifacts>')
+        self._fobj.flush()
 
     def __enter__(self):
         return self
@@ -194,16 +210,27 @@ class AssessmentSummary:
         return elem
 
     def __exit__(self, exception_type, value, traceback):
-        AssessmentSummary._add(self._root, 'stop-ts', utillib.posix_epoch())
+        self._fobj.write('</assessment-artifacts>')
+
+        envs_elem = self._env_table.get_environments()
+        if envs_elem is not None:
+            self._write(envs_elem)
+
+        stop_ts = ET.Element('stop-ts')
+        stop_ts.text = utillib.posix_epoch()
+        self._write(stop_ts)
+        self._fobj.write('</assessment-summary>')
+        self._fobj.close()
 
-        tree = ET.ElementTree(self._root)
-        tree.write(self._filename, encoding='UTF-8', xml_declaration=True)
+    def _write(self, elem):
+        self._fobj.write(ET.tostring(elem, encoding='unicode'))
+        self._fobj.flush()
 
     def add_non_assessment(self, build_artifact_id, cmd, exit_code,
                            execution_successful, environ, cwd, report, stdout, stderr,
                            starttime, endtime):
 
-        non_assess_elem = AssessmentSummary._add(self._assessment_artifacts, 'non-assessment')
+        non_assess_elem = ET.Element('non-assessment')
 
         if build_artifact_id:
             AssessmentSummary._add(non_assess_elem, 'build-artifact-id',
@@ -222,20 +249,20 @@ class AssessmentSummary:
         cmd_elem = AssessmentSummary._add(non_assess_elem, 'command')
 
         AssessmentSummary._add(cmd_elem, 'cwd', cwd)
-        env_elem = AssessmentSummary._add(cmd_elem, 'environment')
-        for key in environ.keys():
-            AssessmentSummary._add(env_elem, 'env', '{0}={1}'.format(key, environ[key]))
+        self._env_table.add(cmd_elem, environ)
 
         AssessmentSummary._add(cmd_elem, 'executable', cmd[0])
         args_elem = AssessmentSummary._add(cmd_elem, 'args')
         for arg in cmd:
             AssessmentSummary._add(args_elem, 'arg', arg)
 
+        self._write(non_assess_elem)
+
     def add_report(self, build_artifact_id, cmd, exit_code,
                    execution_successful, environ, cwd, report, stdout,
                    stderr, starttime, endtime):
 
-        assess_elem = AssessmentSummary._add(self._assessment_artifacts, 'assessment')
+        assess_elem = ET.Element('assessment')
         if build_artifact_id:
             AssessmentSummary._add(assess_elem, 'build-artifact-id',
                                    str(build_artifact_id) if isinstance(build_artifact_id, int) \
@@ -253,19 +280,20 @@ class AssessmentSummary:
         cmd_elem = AssessmentSummary._add(assess_elem, 'command')
 
         AssessmentSummary._add(cmd_elem, 'cwd', cwd)
-        env_elem = AssessmentSummary._add(cmd_elem, 'environment')
-        for key in environ.keys():
-            AssessmentSummary._add(env_elem, 'env', '{0}={1}'.format(key, environ[key]))
+        self._env_table.add(cmd_elem, environ)
 
         AssessmentSummary._add(cmd_elem, 'executable', cmd[0])
         args_elem = AssessmentSummary._add(cmd_elem, 'args')
         for arg in cmd:
             AssessmentSummary._add(args_elem, 'arg', arg)
 
+        self._write(assess_elem)
+
 
 class SwaTool:
 
     TOOL_DOT_CONF = 'tool.conf'
+    CACHED_PATH = '@RUBY_ASSESS_CACHED_PATH@'
 
     @classmethod
     def get_services_conf(cls, tool_type, input_root_dir):
@@ -277,41 +305,201 @@ class SwaTool:
         else:
             return dict()
 
-    def __init__(self, input_root_dir, output_root_dir, tool_root_dir):
+    @classmethod
+    def read_tool_conf(cls, input_root_dir):
+        '''returns tool.conf with the tool-defaults file and the services.conf
+        settings of the tool merged in'''
 
         tool_conf_file = osp.join(input_root_dir, SwaTool.TOOL_DOT_CONF)
-        self.tool_root_dir = tool_root_dir
-        self.input_root_dir = input_root_dir
-
         tool_conf = confreader.read_conf_into_dict(tool_conf_file)
 
         if 'tool-defaults' in tool_conf:
             tool_defaults_file = osp.join(input_root_dir, tool_conf['tool-defaults'])
-            self._tool_conf = confreader.read_conf_into_dict(tool_defaults_file)
-            self._tool_conf.update(tool_conf)
+            merged_conf = confreader.read_conf_into_dict(tool_defaults_file)
+            merged_conf.update(tool_conf)
         else:
-            self._tool_conf = tool_conf
-        
-        self._tool_conf.update(SwaTool.get_services_conf(self._tool_conf['tool-type'], input_root_dir))
-            
-        self._tool_conf = {key: utillib.expandvar(self._tool_conf[key], self._tool_conf) \
-                           for key in self._tool_conf}
+            merged_conf = tool_conf
+
+        merged_conf.update(SwaTool.get_services_conf(merged_conf['tool-type'], input_root_dir))
+
+        return {key: utillib.expandvar(merged_conf[key], merged_conf) \
+                for key in merged_conf}
+
+    def __init__(self, input_root_dir, output_root_dir, tool_root_dir, install=True):
+        '''unarchives the tool, and installs it unless install is False,
+        install() installs it later'''
+
+        self.tool_root_dir = tool_root_dir
+        self.input_root_dir = input_root_dir
+        self.output_root_dir = output_root_dir
+
+        self._run_conf = utillib.get_run_conf(input_root_dir)
+        self._tool_conf = SwaTool.read_tool_conf(input_root_dir)
 
-        self._unarchive(input_root_dir, tool_root_dir)
         logging.info('TOOL CONF: %s', self._tool_conf)
-        self._install(tool_root_dir, output_root_dir) 
+
+        self._tool_cache = cache.get_cache('tool', self._run_conf)
+        self._tool_cache_key = self._get_tool_cache_key(input_root_dir) \
+            if self._tool_cache else None
+        self._tool_cached = self._unarchive_tool()
+
+        if install:
+            self.install()
+
+        self._assess_cache = cache.get_cache('assess', self._run_conf)
+        self._tool_digest = None
+        self._dependency_digests = dict()
+
+    def install(self):
+        '''installs the tool unarchived with install=False, returns self'''
+
+        if 'tool-install-cmd' in self._tool_conf:
+            # installs gems, not at the same time as a build
+            with lock_gem_dirs():
+                self._install_tool()
+        else:
+            self._install_tool()
+
+        return self
+
+    def _unarchive_tool(self):
+        '''unarchives the tool, or links it from the tool cache, returns
+        True if it is linked from the tool cache'''
+
+        if self._tool_cache_key:
+            # not removed by the gc of another process while it is linked
+            with self._tool_cache.lock(self._tool_cache_key):
+                entry_dir = self._tool_cache.get(self._tool_cache_key)
+                if entry_dir:
+                    with LogTaskStatus('tool-unarchive') as status_dot_out:
+                        utillib.link_tree(osp.join(entry_dir, 'tool'), self.tool_root_dir)
+                        status_dot_out.skip_task('cached')
+                    return True
+
+        self._unarchive(self.input_root_dir, self.tool_root_dir)
+        return False
+
+    def _install_tool(self):
+        '''installs the tool, or restores the gems its install command
+        installed from the tool cache'''
+
+        tool_cache = self._tool_cache
+        cache_key = self._tool_cache_key
+        tool_root_dir = self.tool_root_dir
+
+        if cache_key:
+            with tool_cache.lock(cache_key):
+                entry_dir = tool_cache.get(cache_key)
+                missing_gems = self._get_missing_gems(entry_dir) if entry_dir else None
+
+                if missing_gems:
+                    # the install command used gems that are not installed anymore
+                    logging.info('TOOL CACHE: %s not installed, removing %s',
+                                 ' '.join(missing_gems), entry_dir)
+                    tool_cache.remove(cache_key)
+                elif entry_dir:
+                    self._restore(entry_dir, tool_root_dir)
+                    return
+
+        gem_user_dir = RubyEnv.get()['gem-user-dir']
+        snapshot = GemHomeSnapshot(gem_user_dir) if cache_key else None
+        installed_gems = get_installed_gems(gem_user_dir) if cache_key else None
+
+        self._install(tool_root_dir, self.output_root_dir)
+
+        if snapshot:
+            paths = snapshot.diff()
+
+            def populate(dirpath):
+                utillib.link_tree(tool_root_dir, osp.join(dirpath, 'tool'))
+                snapshot.save(paths, osp.join(dirpath, 'gem-home'))
+                utillib.write_to_file(osp.join(dirpath, 'gems'), installed_gems)
+
+            try:
+                tool_cache.put(cache_key, populate)
+                tool_cache.gc()
+                logging.info('TOOL CACHE: saved %s and %d files of %s',
+                             tool_root_dir, len(paths), gem_user_dir)
+            except OSError as err:
+                logging.warning('TOOL CACHE: %s', err)
+
+    def set_input_dir(self, input_root_dir):
+        '''assesses the package in input_root_dir, with the same tool.conf as
+        the package the tool was set up for, with its run.conf and the tool
+        configuration files in its input directory'''
+
+        self.input_root_dir = input_root_dir
+        self._run_conf = utillib.get_run_conf(input_root_dir)
+        self._assess_cache = cache.get_cache('assess', self._run_conf)
+        self._tool_digest = None
+        self._dependency_digests = dict()
+
+    def _get_tool_cache_key(self, input_root_dir):
+        '''digest of the tool archive, the install command, the ruby version
+        and platform, and the gem directory the tool is installed in'''
+
+        ruby_env = RubyEnv.get()
+        key_data = [utillib.file_digest(osp.join(input_root_dir,
+                                                 self._tool_conf['tool-archive'])),
+                    self._tool_conf.get('tool-install-cmd', ''),
+                    self._tool_conf.get('tool-dir', ''),
+                    ruby_env['ruby-version'],
+                    ruby_env['ruby-platform'],
+                    ruby_env['gem-user-dir']]
+
+        return utillib.string_digest('\n'.join(key_data))
+
+    def _get_missing_gems(self, entry_dir):
+        '''returns the gems that were in the gem user directory when the tool
+        in the tool cache entry_dir was installed and are not anymore'''
+
+        gems_file = osp.join(entry_dir, 'gems')
+        if not osp.isfile(gems_file):
+            return []
+
+        with open(gems_file) as fobj:
+            gems = [line.strip() for line in fobj if line.strip()]
+
+        installed_gems = set(get_installed_gems(RubyEnv.get()['gem-user-dir']))
+        return [gem for gem in gems if gem not in installed_gems]
+
+    def _restore(self, entry_dir, tool_root_dir):
+        '''links the gems the install command of the tool installed from the
+        tool cache entry_dir, and the installed tool if it was unarchived'''
+
+        with LogTaskStatus('tool-install') as status_dot_out:
+            if not self._tool_cached:
+                # added to the cache since the tool was unarchived
+                utillib.link_tree(osp.join(entry_dir, 'tool'), tool_root_dir)
+            if osp.isdir(osp.join(entry_dir, 'gem-home')):
+                GemHomeSnapshot.restore(osp.join(entry_dir, 'gem-home'),
+                                        RubyEnv.get()['gem-user-dir'])
+            self._set_executable(tool_root_dir)
+            status_dot_out.skip_task('cached')
+
+        logging.info('TOOL CACHE: restored %s', entry_dir)
+
+    def _set_executable(self, tool_root_dir):
+        '''a tool that is not installed is run from the tool directory'''
+
+        if 'tool-install-cmd' not in self._tool_conf:
+            self._tool_conf['executable'] = osp.normpath(osp.join(osp.join(tool_root_dir,
+                                                                           self._tool_conf['tool-dir']),
+                                                                  self._tool_conf['executable']))
 
     def _unarchive(self, input_root_dir, tool_root_dir):
 
         with LogTaskStatus('tool-unarchive'):
             tool_archive = osp.join(input_root_dir, self._tool_conf['tool-archive'])
-            exit_code = utillib.unpack_archive(tool_archive, tool_root_dir)
+            exit_code = utillib.unpack_archive(tool_archive, tool_root_dir,
+                                               unpack_cache=cache.get_cache('unpack',
+                                                                            self._run_conf))
 
             if exit_code != 0:
                 raise UnpackArchiveError(self._tool_conf['tool-archive'])
 
     def _get_env(self):
-        gem_user_dir = subprocess.getoutput("ruby -r rubygems -e 'puts Gem.user_dir'")
+        gem_user_dir = RubyEnv.get()['gem-user-dir']
         #logging.info('GEM USER DIR: %s', gem_user_dir)
         new_env = dict(os.environ)
         new_env['PATH'] = '%s/bin:%s' % (gem_user_dir, new_env.get('PATH', ''))
@@ -325,10 +513,7 @@ class SwaTool:
         with LogTaskStatus('tool-install') as status_dot_out:
 
             if 'tool-install-cmd' not in self._tool_conf:
-                self._tool_conf['executable'] = osp.normpath(osp.join(osp.join(tool_root_dir,
-                                                                               self._tool_conf['tool-dir']),
-                                                                      self._tool_conf['executable']))
-
+                self._set_executable(tool_root_dir)
                 status_dot_out.skip_task()
             else:
                 # Some packages have tool installed as part of their dependencies
@@ -384,14 +569,110 @@ class SwaTool:
                         line_num += 1
         return err_msg
     
-    def assess(self, build_summary_file, results_root_dir):
+    def _run_assess_cmd(self, assess_cmd, outfile, errfile, cwd):
+        '''runs a single tool invocation, safe to call from worker threads'''
+
+        logging.info('ASSESSMENT CMD: %s', assess_cmd)
+
+        start_time = utillib.posix_epoch()
+        exit_code, environ = utillib.run_cmd(assess_cmd,
+                                             outfile=outfile,
+                                             errfile=errfile,
+                                             cwd=cwd,
+                                             env=self._get_env())
+        end_time = utillib.posix_epoch()
+
+        logging.info('ASSESSMENT WORKING DIR: %s', cwd)
+        logging.info('ASSESSMENT EXIT CODE: %d', exit_code)
+        logging.info('ASSESSMENT ENVIRONMENT: %s', environ)
+
+        return (exit_code, environ, start_time, end_time)
+
+    def _get_tool_digest(self):
+        '''digest of the tool, its configuration and invocation'''
+
+        if self._tool_digest is None:
+            digests = [self._tool_conf['tool-type'], self._tool_conf['tool-version']]
+
+            for conf_file in [SwaTool.TOOL_DOT_CONF,
+                              self._tool_conf.get('tool-defaults'),
+                              self._tool_conf.get('tool-invoke'),
+                              self._tool_conf.get('tool-archive')]:
+                if conf_file and osp.isfile(osp.join(self.input_root_dir, conf_file)):
+                    digests.append(utillib.file_digest(osp.join(self.input_root_dir,
+                                                                conf_file)))
+
+            services_conf = SwaTool.get_services_conf(self._tool_conf['tool-type'],
+                                                      self.input_root_dir)
+            digests.extend('{0}={1}'.format(key, services_conf[key])
+                           for key in sorted(services_conf.keys()))
+
+            self._tool_digest = utillib.string_digest('\n'.join(digests))
+
+        return self._tool_digest
+
+    def _get_dependency_digest(self, dependencies, jobs=1):
+        '''digest of the contents of the dependency files and directories,
+        such as the lib directories of gems, the tool reads besides the
+        files it assesses; each path is read once per run'''
+
+        for path in dependencies:
+            if path not in self._dependency_digests:
+                self._dependency_digests[path] = utillib.tree_digest(path, jobs)
+
+        return utillib.string_digest('\n'.join(self._dependency_digests[path]
+                                               for path in sorted(dependencies)))
+
+    def _cache_put(self, key, exit_code, files, path):
+        '''Adds the tool output files, a dict of name: filepath, to the
+        assessment cache. Occurrences of path in the files are replaced so
+        the output can be replayed for files at another location'''
+
+        def populate(entry_dir):
+            for name, filepath in files.items():
+                if osp.isfile(filepath):
+                    utillib.copy_replace(filepath, osp.join(entry_dir, name),
+                                         path, SwaTool.CACHED_PATH)
+
+            utillib.write_to_file(osp.join(entry_dir, 'result.conf'),
+                                  {'exit-code': str(exit_code)})
+
+        try:
+            self._assess_cache.put(key, populate)
+        except OSError as err:
+            logging.warning('ASSESSMENT CACHE: %s', err)
+
+    def _cache_replay(self, key, files, path):
+        '''Writes the cached tool output files of key, returns the exit code,
+        None if key is not in the assessment cache or its entry cannot be read'''
+
+        try:
+            # not removed by the gc of another process while it is replayed
+            with self._assess_cache.lock(key):
+                entry_dir = self._assess_cache.get(key)
+                if not entry_dir:
+                    return None
+
+                for name, filepath in files.items():
+                    if osp.isfile(osp.join(entry_dir, name)):
+                        utillib.copy_replace(osp.join(entry_dir, name), filepath,
+                                             SwaTool.CACHED_PATH, path)
+
+                result_conf = confreader.read_conf_into_dict(osp.join(entry_dir,
+                                                                      'result.conf'))
+                return int(result_conf['exit-code'])
+        except (OSError, KeyError, ValueError) as err:
+            logging.warning('ASSESSMENT CACHE: %s', err)
+            return None
+
+    def assess(self, build_summary_file, results_root_dir, jobs=1):
         raise NotImplementedError
 
     
 class RubyLint(SwaTool):
 
-    def __init__(self, input_root_dir, output_root_dir, tool_root_dir):
-        SwaTool.__init__(self, input_root_dir, output_root_dir, tool_root_dir)
+    def __init__(self, input_root_dir, output_root_dir, tool_root_dir, install=True):
+        SwaTool.__init__(self, input_root_dir, output_root_dir, tool_root_dir, install)
 
     def create_config_file(self, dependencies):
         config_file = osp.join(self.tool_root_dir, 'ruby-lint.yml')
@@ -411,7 +692,133 @@ class RubyLint(SwaTool):
                 line1 = fobj.readline().strip()
                 return True if line1.endswith('(RuntimeError)') else False
 
-    def assess(self, build_summary_file, results_root_dir):
+    @classmethod
+    def _get_report_srcfile(cls, line, srcfiles):
+        '''syntastic lines are <file>:<level>:<line>:<column>: <message>,
+        file paths can have colons in them'''
+
+        idx = line.find(':')
+        while idx != -1:
+            if line[:idx] in srcfiles:
+                return line[:idx]
+            idx = line.find(':', idx + 1)
+
+        return None
+
+    @classmethod
+    def _split_report(cls, report, assess_tasks):
+        '''writes lines of a multi-file syntastic report to per file reports'''
+
+        outfiles = {srcfile: open(outfile, 'w') for (_, srcfile, outfile, _) in assess_tasks}
+
+        try:
+            with open(report) as fobj:
+                current = None
+                for line in fobj:
+                    srcfile = RubyLint._get_report_srcfile(line, outfiles)
+
+                    if srcfile:
+                        current = srcfile
+
+                    if current:
+                        outfiles[current].write(line)
+                    else:
+                        logging.warning('ASSESSMENT REPORT LINE WITHOUT FILE: %s', line.strip())
+        finally:
+            for fobj in outfiles.values():
+                fobj.close()
+
+    def _get_batches(self, assess_cmd_template, assess_tasks, jobs):
+        '''Groups files to be assessed by a single ruby-lint invocation,
+        each group fits in the max command line size, and there are
+        at least as many groups as jobs'''
+
+        if not utillib.string_to_bool(self._run_conf.get('assess-batch', 'false')):
+            return [[task] for task in assess_tasks]
+
+        max_count = math.ceil(len(assess_tasks) / jobs)
+        if self._run_conf.get('assess-batch-size'):
+            max_count = min(max_count, int(self._run_conf['assess-batch-size']))
+
+        max_size = utillib.max_cmd_size() - len(' '.join(assess_cmd_template))
+
+        return utillib.split_args(assess_tasks, max_size, max_count,
+                                  lambda task: task[1])
+
+    def _get_cache_keys(self, assess_tasks, assess_cmd_template, artifacts, jobs):
+        '''Returns assessment cache keys of the files, a key is a digest
+        of the file contents, the tool, the ruby-lint.yml and the contents
+        of the dependency directories it lists, as ruby-lint reads the
+        definitions of the other files in them'''
+
+        if not self._assess_cache:
+            return [None] * len(assess_tasks)
+
+        config_digest = ''
+        if '--config' in assess_cmd_template:
+            config_file = assess_cmd_template[assess_cmd_template.index('--config') + 1]
+            with open(config_file) as fobj:
+                config = sorted(line.replace(artifacts['build-root-dir'], SwaTool.CACHED_PATH)
+                                for line in fobj)
+                config_digest = utillib.string_digest(''.join(config))
+
+        dependency_digest = self._get_dependency_digest(artifacts.get('dependency', []), jobs)
+
+        file_digests = utillib.parallel_map(utillib.file_digest,
+                                            [srcfile for (_, srcfile, _, _) in assess_tasks],
+                                            jobs)
+
+        return [utillib.string_digest('\n'.join([self._get_tool_digest(),
+                                                 config_digest,
+                                                 dependency_digest,
+                                                 file_digest]))
+                for file_digest in file_digests]
+
+    def _assess_file(self, assess_cmd_template, task, results_root_dir):
+
+        (_, srcfile, outfile, errfile) = task
+
+        assess_cmd = list(assess_cmd_template)
+        assess_cmd.append(srcfile)
+
+        (exit_code, environ,
+         start_time, end_time) = self._run_assess_cmd(assess_cmd, outfile,
+                                                      errfile, results_root_dir)
+
+        return (exit_code, environ, start_time, end_time, assess_cmd, errfile)
+
+    def _assess_batch(self, assess_cmd_template, batch_id, batch, results_root_dir):
+        '''Assess all files in the batch with one invocation, fallback to
+        one invocation per file if the batch fails. Returns a result per file'''
+
+        if len(batch) == 1:
+            return [self._assess_file(assess_cmd_template, batch[0], results_root_dir)]
+
+        assess_cmd = list(assess_cmd_template)
+        assess_cmd.extend([srcfile for (_, srcfile, _, _) in batch])
+
+        outfile = osp.join(results_root_dir, 'swa_tool_stdout{0}.out'.format(batch_id))
+        errfile = osp.join(results_root_dir, 'swa_tool_stderr{0}.out'.format(batch_id))
+
+        (exit_code, environ,
+         start_time, end_time) = self._run_assess_cmd(assess_cmd, outfile,
+                                                      errfile, results_root_dir)
+
+        if not self._validate_exit_code(exit_code) or \
+           RubyLint._has_runtime_errors(errfile):
+            logging.info('ASSESSMENT BATCH %s FAILED, ASSESSING ONE FILE AT A TIME', batch_id)
+            utillib.rmfile(outfile)
+            utillib.rmfile(errfile)
+            return [self._assess_file(assess_cmd_template, task, results_root_dir)
+                    for task in batch]
+
+        RubyLint._split_report(outfile, batch)
+        utillib.rmfile(outfile)
+
+        return [(exit_code, environ, start_time, end_time, assess_cmd, errfile)
+                for task in batch]
+
+    def assess(self, build_summary_file, results_root_dir, jobs=1):
 
         if not osp.isdir(results_root_dir):
             os.makedirs(results_root_dir, exist_ok=True)
@@ -422,7 +829,9 @@ class RubyLint(SwaTool):
 
         with AssessmentSummary(assessment_summary_file,
                                build_artifacts_helper,
-                               self._tool_conf) as assessment_summary:
+                               self._tool_conf,
+                               self._run_conf.get('summary-env-layout',
+                                                  utillib.EnvironmentTable.INLINE)) as assessment_summary:
             passed = 0
             failed = 0
 
@@ -438,38 +847,81 @@ class RubyLint(SwaTool):
                         config_file = self.create_config_file(artifacts['dependency'])
                         assess_cmd_template.extend(['--config', config_file])
 
+                    assess_tasks = list()
                     file_count = 0
 
                     for srcfile in artifacts['include']:
 
-                        assess_cmd = list(assess_cmd_template)
-
-                        assess_cmd.append(srcfile)
-
-                        logging.info('ASSESSMENT CMD: %s', assess_cmd)
-
                         file_count += 1
                         artifacts_id = '{0}-{1}'.format(artifacts['id'], file_count)
                         outfile = osp.join(results_root_dir, 'assessment_report{0}.out'.format(artifacts_id))
                         errfile = osp.join(results_root_dir, 'swa_tool_stderr{0}.out'.format(artifacts_id))
 
-                        start_time = utillib.posix_epoch()
-                        exit_code, environ = utillib.run_cmd(assess_cmd,
-                                                             outfile=outfile,
-                                                             errfile=errfile,
-                                                             cwd=results_root_dir,
-                                                             #env=dict(os.environ))
-                                                             env=self._get_env())
-                        end_time = utillib.posix_epoch()
-
-                        logging.info('ASSESSMENT WORKING DIR: %s', results_root_dir)
-                        logging.info('ASSESSMENT EXIT CODE: %d', exit_code)
-                        logging.info('ASSESSMENT ENVIRONMENT: %s', environ)
+                        assess_tasks.append((artifacts_id, srcfile, outfile, errfile))
+
+                    cache_keys = self._get_cache_keys(assess_tasks, assess_cmd_template,
+                                                      artifacts, jobs)
+                    cache_entries = {key: self._assess_cache.get(key)
+                                     for key in cache_keys if key}
+
+                    batches = self._get_batches(assess_cmd_template,
+                                                [task for (task, key) in zip(assess_tasks, cache_keys)
+                                                 if not cache_entries.get(key)],
+                                                jobs)
+
+                    def run_batch(batch_num):
+                        return self._assess_batch(assess_cmd_template,
+                                                  '{0}-b{1}'.format(artifacts['id'], batch_num + 1),
+                                                  batches[batch_num],
+                                                  results_root_dir)
+
+                    def batch_size(batch_num):
+                        return sum(osp.getsize(srcfile) if osp.isfile(srcfile) else 0
+                                   for (_, srcfile, _, _) in batches[batch_num])
+
+                    # largest batches first, reports are still added in file order
+                    results = utillib.parallel_map(run_batch, range(len(batches)),
+                                                   jobs, batch_size)
+                    results = (result for batch_results in results for result in batch_results)
+
+                    for task, cache_key in zip(assess_tasks, cache_keys):
+                        (artifacts_id, srcfile, outfile, errfile) = task
+                        exit_code = None
+
+                        if cache_entries.get(cache_key):
+                            assess_cmd = assess_cmd_template + [srcfile]
+                            start_time = utillib.posix_epoch()
+                            exit_code = self._cache_replay(cache_key,
+                                                           {'report': outfile, 'stderr': errfile},
+                                                           srcfile)
+                            end_time = utillib.posix_epoch()
+                            environ = self._get_env()
+
+                        cached = exit_code is not None
+                        if cached:
+                            logging.info('ASSESSMENT CACHED: %s', srcfile)
+                        elif cache_entries.get(cache_key):
+                            # removed from the cache since it was looked up
+                            (exit_code, environ, start_time, end_time,
+                             assess_cmd, errfile) = self._assess_file(assess_cmd_template,
+                                                                      task, results_root_dir)
+                        else:
+                            (exit_code, environ, start_time, end_time,
+                             assess_cmd, errfile) = next(results)
 
                         if self._validate_exit_code(exit_code) and \
                                 not RubyLint._has_runtime_errors(errfile):
                             passed += 1
                             execution_successful = True
+
+                            # the stderr of a batch is shared by its files, their
+                            # results are not cached
+                            batched = errfile != task[3]
+
+                            if cache_key and not cached and not batched:
+                                self._cache_put(cache_key, exit_code,
+                                                {'report': outfile, 'stderr': errfile},
+                                                srcfile)
                         else:
                             failed += 1
                             execution_successful = False
@@ -488,15 +940,120 @@ class RubyLint(SwaTool):
                                                       start_time,
                                                       end_time)
 
+            if self._assess_cache:
+                self._assess_cache.gc()
+
             return (passed, failed, '', assessment_summary_file)
 
 
 class RubyTool(SwaTool):
 
-    def __init__(self, input_root_dir, output_root_dir, tool_root_dir):
-        SwaTool.__init__(self, input_root_dir, output_root_dir, tool_root_dir)
+    def __init__(self, input_root_dir, output_root_dir, tool_root_dir, install=True):
+        SwaTool.__init__(self, input_root_dir, output_root_dir, tool_root_dir, install)
+
+    def _get_shards(self, artifacts):
+        '''Splits the files of an artifact into shards, each shard is assessed
+        with a command that fits in the max command line size. Shards get
+        <artifact-id>-<shard-num> ids, an artifact that needs no splitting
+        keeps its id'''
+
+        invoke_file = osp.join(self.input_root_dir, artifacts['tool-invoke'])
+        params = gencmd.get_param_list(invoke_file)
+
+        if 'srcfile' not in params and 'include' not in params:
+            return [artifacts]
+
+        files_size = sum(len(_file.encode('utf-8')) + 1 for _file in artifacts['include'])
+
+        # a placeholder file, <srcfile> and <include> without % expand to
+        # their first file
+        no_files = dict(artifacts)
+        no_files['include'] = no_files['srcfile'] = ['']
+        no_files['assessment-report'] = artifacts.get('assessment-report', '')
+        max_size = utillib.max_cmd_size() - len(' '.join(gencmd.gencmd(invoke_file, no_files)))
+
+        max_count = None
+        if self._run_conf.get('assess-shard-size'):
+            max_count = int(self._run_conf['assess-shard-size'])
+
+        if files_size <= max_size and \
+           (max_count is None or len(artifacts['include']) <= max_count):
+            return [artifacts]
+
+        shards = list()
+        for shard_num, files in enumerate(utillib.split_args(artifacts['include'],
+                                                             max_size,
+                                                             max_count)):
+            shard = dict(artifacts)
+            shard['id'] = '{0}-{1}'.format(artifacts['id'], shard_num + 1)
+            shard['include'] = shard['srcfile'] = files
+            shards.append(shard)
+
+        logging.info('ASSESSMENT ARTIFACT %s SPLIT INTO %d SHARDS',
+                     artifacts['id'], len(shards))
+        return shards
+
+    def _get_cache_key(self, artifacts, pkg_dir):
+        '''Returns the assessment cache key of an artifact or shard, a digest
+        of the tool and the paths and contents of its files and dependencies'''
+
+        if not self._assess_cache:
+            return None
+
+        digests = [self._get_tool_digest()]
+        digests.extend('{0}:{1}'.format(osp.relpath(_file, pkg_dir), utillib.file_digest(_file))
+                       for _file in sorted(artifacts['include']))
+        digests.extend(_file.replace(pkg_dir, SwaTool.CACHED_PATH)
+                       for _file in sorted(artifacts.get('dependency', [])))
+        digests.append(self._get_dependency_digest(artifacts.get('dependency', [])))
+
+        return utillib.string_digest('\n'.join(digests))
+
+    def _assess_artifacts(self, artifacts, assessment_report_template, results_root_dir):
+
+        assessment_report = osp.join(results_root_dir,
+                                     assessment_report_template.format(artifacts['id']))
+
+        if 'report-on-stdout' in artifacts \
+           and artifacts['report-on-stdout'] == 'true':
+            outfile = assessment_report
+        else:
+            artifacts['assessment-report'] = assessment_report
+            outfile = osp.join(results_root_dir,
+                               'swa_tool_stdout{0}.out'.format(artifacts['id']))
+
+        errfile = osp.join(results_root_dir,
+                           'swa_tool_stderr{0}.out'.format(artifacts['id']))
+
+        assess_cmd = gencmd.gencmd(osp.join(self.input_root_dir,
+                                            artifacts['tool-invoke']),
+                                   artifacts)
+
+        pkg_dir = osp.join(artifacts['build-root-dir'],
+                           artifacts['package-root-dir'],
+                           artifacts.get('package-dir') or '')
+        output_files = {'report': assessment_report, 'stdout': outfile, 'stderr': errfile}
+        cache_key = self._get_cache_key(artifacts, pkg_dir)
+
+        start_time = utillib.posix_epoch()
+        exit_code = self._cache_replay(cache_key, output_files, pkg_dir) if cache_key else None
+
+        if exit_code is not None:
+            logging.info('ASSESSMENT CACHED: %s', artifacts['id'])
+            end_time = utillib.posix_epoch()
+            environ = self._get_env()
+        else:
+            (exit_code, environ,
+             start_time, end_time) = self._run_assess_cmd(assess_cmd, outfile,
+                                                          errfile, results_root_dir)
+
+            if cache_key and self._validate_exit_code(exit_code):
+                self._cache_put(cache_key, exit_code, output_files, pkg_dir)
+
+        return (assess_cmd, exit_code, environ, start_time, end_time,
+                assessment_report, outfile, errfile)
 
-    def assess(self, build_summary_file, results_root_dir):
+    def assess(self, build_summary_file, results_root_dir, jobs=1):
 
         if not osp.isdir(results_root_dir):
             os.makedirs(results_root_dir, exist_ok=True)
@@ -516,81 +1073,72 @@ class RubyTool(SwaTool):
 
         with AssessmentSummary(assessment_summary_file,
                                build_artifacts_helper,
-                               self._tool_conf) as assessment_summary:
+                               self._tool_conf,
+                               self._run_conf.get('summary-env-layout',
+                                                  utillib.EnvironmentTable.INLINE)) as assessment_summary:
 
             for artifacts in build_artifacts_helper.get_build_artifacts('ruby-src'):
 
                 artifacts.update(self._tool_conf)
-                assessment_report = osp.join(results_root_dir,
-                                             assessment_report_template.format(artifacts['id']))
-
-                if 'report-on-stdout' in artifacts \
-                   and artifacts['report-on-stdout'] == 'true':
-                    outfile = assessment_report
-                else:
-                    artifacts['assessment-report'] = assessment_report
-                    outfile = osp.join(results_root_dir,
-                                       'swa_tool_stdout{0}.out'.format(artifacts['id']))
-
-                errfile = osp.join(results_root_dir,
-                                   'swa_tool_stderr{0}.out'.format(artifacts['id']))
 
                 skip_assess = 'include' not in artifacts or len(artifacts['include']) == 0
 
                 if not skip_assess:
-                    assess_cmd = gencmd.gencmd(osp.join(self.input_root_dir,
-                                                        artifacts['tool-invoke']),
-                                               artifacts)
-
-                    logging.info('ASSESSMENT CMD: %s', assess_cmd)
-
-                    start_time = utillib.posix_epoch()
-                    exit_code, environ = utillib.run_cmd(assess_cmd,
-                                                         outfile=outfile,
-                                                         errfile=errfile,
-                                                         cwd=results_root_dir,
-                                                         env=self._get_env())
-                    end_time = utillib.posix_epoch()
-
-                    logging.info('ASSESSMENT WORKING DIR: %s', results_root_dir)
-                    logging.info('ASSESSMENT EXIT CODE: %d', exit_code)
-                    logging.info('ASSESSMENT ENVIRONMENT: %s', environ)
-
-                    if self._validate_exit_code(exit_code):
-                        passed += 1
-                        execution_successful = True
-                    else:
-                        failed += 1
-                        err_msgs += self._read_err_msg(exit_code, outfile, errfile)
-                        execution_successful = False
-
-                    #write assessment summary file
-                    #return pass, fail, assessment_summary
-                    assessment_summary.add_report(artifacts['id'],
-                                                  assess_cmd,
-                                                  exit_code,
-                                                  execution_successful,
-                                                  environ,
-                                                  results_root_dir,
-                                                  assessment_report,
-                                                  assessment_report,
-                                                  errfile,
-                                                  start_time,
-                                                  end_time)
-                            
+                    shards = self._get_shards(artifacts)
+
+                    def run_shard(shard):
+                        return self._assess_artifacts(shard,
+                                                      assessment_report_template,
+                                                      results_root_dir)
+
+                    def shard_size(shard):
+                        return sum(osp.getsize(_file) if osp.isfile(_file) else 0
+                                   for _file in shard['include'])
+
+                    results = utillib.parallel_map(run_shard, shards, jobs, shard_size)
+
+                    for shard, result in zip(shards, results):
+                        (assess_cmd, exit_code, environ, start_time, end_time,
+                         assessment_report, outfile, errfile) = result
+
+                        if self._validate_exit_code(exit_code):
+                            passed += 1
+                            execution_successful = True
+                        else:
+                            failed += 1
+                            err_msgs += self._read_err_msg(exit_code, outfile, errfile)
+                            execution_successful = False
+
+                        #write assessment summary file
+                        #return pass, fail, assessment_summary
+                        assessment_summary.add_report(shard['id'],
+                                                      assess_cmd,
+                                                      exit_code,
+                                                      execution_successful,
+                                                      environ,
+                                                      results_root_dir,
+                                                      assessment_report,
+                                                      assessment_report,
+                                                      errfile,
+                                                      start_time,
+                                                      end_time)
+
                 else:
                     logging.info('ASSESSMENT SKIP (NO SOURCE FILES FOUND)')
-                    
+
+            if self._assess_cache:
+                self._assess_cache.gc()
+
             return (passed, failed, err_msgs, assessment_summary_file)
 
 
 class Dawnscanner(RubyTool):
 
-    def __init__(self, input_root_dir, output_root_dir, tool_root_dir):
-        RubyTool.__init__(self, input_root_dir, output_root_dir, tool_root_dir)
+    def __init__(self, input_root_dir, output_root_dir, tool_root_dir, install=True):
+        RubyTool.__init__(self, input_root_dir, output_root_dir, tool_root_dir, install)
 
     def _get_env(self):
-        gem_user_dir = subprocess.getoutput("ruby -r rubygems -e 'puts Gem.user_dir'")
+        gem_user_dir = RubyEnv.get()['gem-user-dir']
         new_env = dict(os.environ)
         new_env['PATH'] = '%s/bin:%s' % (gem_user_dir, new_env.get('PATH', ''))
         new_env['GEM_PATH'] = '%s' % (gem_user_dir)
@@ -599,8 +1147,8 @@ class Dawnscanner(RubyTool):
 
 class Reek(RubyTool):
 
-    def __init__(self, input_root_dir, output_root_dir, tool_root_dir):
-        RubyTool.__init__(self, input_root_dir, output_root_dir, tool_root_dir)
+    def __init__(self, input_root_dir, output_root_dir, tool_root_dir, install=True):
+        RubyTool.__init__(self, input_root_dir, output_root_dir, tool_root_dir, install)
 
     def _install(self, tool_root_dir, output_root_dir):
 
@@ -637,20 +1185,27 @@ class Reek(RubyTool):
                                                  "Command '{0}' return {1}".format(install_cmd, exit_code))
     
 
-def assess(input_root_dir, output_root_dir, tool_root_dir,
-           results_root_dir, build_summary_file):
+def get_swatool(input_root_dir, output_root_dir, tool_root_dir, install=True):
+    '''unarchives and installs the tool in tool.conf, returns its SwaTool.
+    With install False the tool is only unarchived, its install() installs it'''
 
     tool_conf_file = osp.join(input_root_dir, SwaTool.TOOL_DOT_CONF)
     tool_conf = confreader.read_conf_into_dict(tool_conf_file)
 
     if tool_conf['tool-type'] == 'ruby-lint':
-        swatool = RubyLint(input_root_dir, output_root_dir, tool_root_dir)
+        return RubyLint(input_root_dir, output_root_dir, tool_root_dir, install)
     elif tool_conf['tool-type'] == 'dawnscanner':
-        swatool = Dawnscanner(input_root_dir, output_root_dir, tool_root_dir)
+        return Dawnscanner(input_root_dir, output_root_dir, tool_root_dir, install)
     elif tool_conf['tool-type'] == 'reek':
-        swatool = Reek(input_root_dir, output_root_dir, tool_root_dir)
+        return Reek(input_root_dir, output_root_dir, tool_root_dir, install)
     else:
-        swatool = RubyTool(input_root_dir, output_root_dir, tool_root_dir)
+        return RubyTool(input_root_dir, output_root_dir, tool_root_dir, install)
+
+def assess(input_root_dir, output_root_dir, tool_root_dir,
+           results_root_dir, build_summary_file, jobs=1, swatool=None):
+
+    if swatool is None:
+        swatool = get_swatool(input_root_dir, output_root_dir, tool_root_dir)
 
     try:
         with LogTaskStatus('assess') as status_dot_out:
@@ -658,7 +1213,9 @@ def assess(input_root_dir, output_root_dir, tool_root_dir,
             (passed,
              failed,
              error_msgs,
-             assessment_summary_file) = swatool.assess(build_summary_file, results_root_dir)
+             assessment_summary_file) = swatool.assess(build_summary_file,
+                                                       results_root_dir,
+                                                       jobs)
 
             if passed == 0 and failed == 0:
                 exit_code = 0
@@ -687,10 +1244,11 @@ def assess(input_root_dir, output_root_dir, tool_root_dir,
             results_conf['assessment-summary-file'] = osp.basename(assessment_summary_file)
 
             with LogTaskStatus('results-archive'):
-                results_archive = shutil.make_archive(osp.join(output_root_dir, 'results'),
-                                                      'gztar',
-                                                      osp.dirname(results_root_dir),
-                                                      osp.basename(results_root_dir))
+                run_conf = utillib.get_run_conf(input_root_dir)
+                results_archive = utillib.make_archive(osp.join(output_root_dir, 'results'),
+                                                       osp.dirname(results_root_dir),
+                                                       osp.basename(results_root_dir),
+                                                       utillib.get_archive_level(run_conf))
 
                 results_conf['results-archive'] = osp.basename(results_archive)
                 results_conf['results-dir'] = osp.basename(results_root_dir)
@@ -0,0 +1,280 @@
+import os
+import sys
+import logging
+import traceback
+import os.path as osp
+
+from . import swamp
+from . import assess
+from . import logger
+from . import confreader
+from . import install_os_dependencies
+from . import results_parser
+from . import utillib
+from .logger import LogTaskStatus
+
+
+def read_manifest(manifest_file):
+    '''returns the list of (input_dir, output_dir) of the packages in
+    manifest_file, one package per line, relative paths are relative to
+    the directory of the manifest'''
+
+    manifest_dir = osp.dirname(osp.realpath(manifest_file))
+    packages = list()
+
+    with open(manifest_file) as fobj:
+        for (lineno, line) in enumerate(fobj, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+
+            fields = line.split()
+            if len(fields) != 2:
+                raise ValueError('{0}:{1}: expected <input-dir> <output-dir>, found {2}'.format(
+                    manifest_file, lineno, line))
+
+            packages.append(tuple(osp.realpath(osp.join(manifest_dir, path)) for path in fields))
+
+    return packages
+
+
+def _get_goal(input_dir):
+    run_conf_file = osp.join(input_dir, 'run.conf')
+
+    if osp.isfile(run_conf_file):
+        return confreader.read_conf_into_dict(run_conf_file).get('goal', '')
+    else:
+        return ''
+
+
+def _get_tool_key(input_dir):
+    '''digest of the tool configuration and the tool archive'''
+
+    tool_conf = assess.SwaTool.read_tool_conf(input_dir)
+    key_data = ['{0}={1}'.format(key, tool_conf[key]) for key in sorted(tool_conf)]
+    key_data.append(utillib.file_digest(osp.join(input_dir, tool_conf['tool-archive'])))
+
+    return utillib.string_digest('\n'.join(key_data))
+
+
+def _get_parser_key(input_dir):
+    '''digest of resultparser.conf and the result parser archive'''
+
+    parser_conf = confreader.read_conf_into_dict(osp.join(input_dir, 'resultparser.conf'))
+    key_data = ['{0}={1}'.format(key, parser_conf[key]) for key in sorted(parser_conf)]
+    key_data.append(utillib.file_digest(osp.join(input_dir,
+                                                 parser_conf['result-parser-archive'])))
+
+    return utillib.string_digest('\n'.join(key_data))
+
+
+class SharedSetup:
+    '''The tools and result parsers set up once for all the packages in a
+    batch with the same tool.conf or resultparser.conf and archive. Each
+    is set up in a setup-tool-<n> or setup-parser-<n> directory of the
+    batch work directory. A package whose tool or result parser failed
+    to set up sets it up again in its own run, to report the failure in
+    its own status.out'''
+
+    def __init__(self, work_dir):
+        self.work_dir = work_dir
+        self._tools = dict()
+        self._parsers = dict()
+
+    def _setup_tool(self, input_dir):
+        setup_dir = osp.join(self.work_dir, 'setup-tool-{0}'.format(len(self._tools) + 1))
+        tool_dir = osp.join(setup_dir, 'tool')
+        os.makedirs(tool_dir, exist_ok=True)
+
+        try:
+            install_os_dependencies.install(input_dir)
+            os.environ['TOOL_DIR'] = tool_dir
+            return (assess.get_swatool(input_dir, setup_dir, tool_dir), tool_dir)
+        except Exception as err:
+            logging.exception(err)
+            return (None, None)
+
+    def _setup_parser(self, input_dir):
+        setup_dir = osp.join(self.work_dir, 'setup-parser-{0}'.format(len(self._parsers) + 1))
+        os.makedirs(setup_dir, exist_ok=True)
+
+        cwd = os.getcwd()
+        try:
+            # the result parser is unarchived in the current directory
+            os.chdir(setup_dir)
+            return results_parser.get_results_parser(input_dir)
+        except Exception as err:
+            logging.exception(err)
+            return None
+        finally:
+            os.chdir(cwd)
+
+    def get_tool(self, input_dir):
+        '''returns (swatool, tool_dir) for the package in input_dir,
+        (None, None) if it does not assess or the tool failed to set up'''
+
+        if 'assess' not in _get_goal(input_dir) or \
+           not osp.isfile(osp.join(input_dir, assess.SwaTool.TOOL_DOT_CONF)):
+            return (None, None)
+
+        try:
+            key = _get_tool_key(input_dir)
+        except (OSError, KeyError) as err:
+            # set up, and reported, by the run of the package
+            logging.exception(err)
+            return (None, None)
+
+        if key not in self._tools:
+            self._tools[key] = self._setup_tool(input_dir)
+
+        return self._tools[key]
+
+    def get_parser(self, input_dir):
+        '''returns the result parser executable for the package in
+        input_dir, None if it does not parse or the parser failed to set up'''
+
+        if 'parse' not in _get_goal(input_dir) or \
+           not osp.isfile(osp.join(input_dir, 'resultparser.conf')):
+            return None
+
+        try:
+            key = _get_parser_key(input_dir)
+        except (OSError, KeyError) as err:
+            # set up, and reported, by the run of the package
+            logging.exception(err)
+            return None
+
+        if key not in self._parsers:
+            self._parsers[key] = self._setup_parser(input_dir)
+
+        return self._parsers[key]
+
+
+def _run_package(input_dir, output_dir, package_dir, swatool, tool_dir, parser_exe_file, jobs):
+    '''runs the goal of one package in a forked process, with its own
+    output directory, status.out and debug.out; returns the exit code'''
+
+    os.makedirs(output_dir, exist_ok=True)
+    os.makedirs(package_dir, exist_ok=True)
+    # parsed_results is created in the current directory
+    os.chdir(package_dir)
+
+    logger.detach()
+    logger.init(output_dir)
+
+    if swatool:
+        swatool.set_input_dir(input_dir)
+    else:
+        tool_dir = osp.join(package_dir, 'tool')
+
+    os.environ['TOOL_DIR'] = tool_dir
+
+    try:
+        return swamp.main(input_dir,
+                          output_dir,
+                          osp.join(package_dir, 'build'),
+                          tool_dir,
+                          osp.join(package_dir, 'results'),
+                          jobs,
+                          swatool,
+                          parser_exe_file)
+    finally:
+        logger.shutdown()
+
+
+def _fork(func, *args):
+    '''runs func(*args) in a child process, returns its pid'''
+
+    # nothing buffered in the parent is written twice
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    pid = os.fork()
+    if pid != 0:
+        return pid
+
+    exit_code = 1
+    try:
+        exit_code = func(*args)
+        sys.stdout.flush()
+        sys.stderr.flush()
+    except BaseException:
+        traceback.print_exc()
+
+    # swamp.main returns the errno of an exception, which can be None
+    if not isinstance(exit_code, int) or not 0 <= exit_code <= 255:
+        exit_code = 1
+
+    # never returns to the caller, which is the batch in the parent
+    os._exit(exit_code)
+
+
+def run(packages, work_dir, workers, jobs=None):
+    '''sets up the tools and result parsers of the packages, then runs the
+    goal of each package in a process of its own, workers at a time.
+    Returns the list of the exit codes of the packages'''
+
+    shared_setup = SharedSetup(work_dir)
+    package_args = list()
+
+    for (index, (input_dir, output_dir)) in enumerate(packages, 1):
+        (swatool, tool_dir) = shared_setup.get_tool(input_dir)
+        parser_exe_file = shared_setup.get_parser(input_dir)
+        package_dir = osp.join(work_dir, 'package-{0}'.format(index))
+
+        package_args.append((input_dir, output_dir, package_dir,
+                             swatool, tool_dir, parser_exe_file, jobs))
+
+    exit_codes = [None] * len(packages)
+    pending = list(range(len(packages)))
+    running = dict()
+
+    while pending or running:
+        while pending and len(running) < workers:
+            index = pending.pop(0)
+            pid = _fork(_run_package, *package_args[index])
+            logging.info('BATCH: package %d %s pid %d', index + 1, packages[index][0], pid)
+            running[pid] = index
+
+        (pid, status) = os.waitpid(-1, 0)
+        if pid in running:
+            index = running.pop(pid)
+            # os.waitstatus_to_exitcode is from Python 3.9
+            if os.WIFEXITED(status):
+                exit_codes[index] = os.WEXITSTATUS(status)
+            else:
+                exit_codes[index] = -os.WTERMSIG(status)
+            logging.info('BATCH: package %d exit code %d', index + 1, exit_codes[index])
+
+    return exit_codes
+
+
+def main(args):
+    '''the batch command, returns 0 if every package exited with 0'''
+
+    with LogTaskStatus('all') as status_dot_out:
+        try:
+            packages = read_manifest(args.manifest)
+        except (OSError, ValueError) as err:
+            logging.exception(err)
+            status_dot_out.update_task_status(1, 'manifest')
+            return 1
+
+        workers = args.workers if args.workers and args.workers > 0 else utillib.cpu_count()
+        logging.info('BATCH: %d packages, %d workers', len(packages), workers)
+
+        exit_codes = run(packages, osp.realpath(args.work_dir), workers, args.jobs)
+
+        for (index, (input_dir, output_dir)) in enumerate(packages):
+            LogTaskStatus.log_task('package-{0}'.format(index + 1),
+                                   exit_codes[index],
+                                   osp.basename(input_dir),
+                                   'output: {0}'.format(output_dir))
+
+        exit_code = 0 if all(code == 0 for code in exit_codes) else 1
+        status_dot_out.update_task_status(exit_code,
+                                          'pass: {0}, fail: {1}'.format(
+                                              exit_codes.count(0),
+                                              len(exit_codes) - exit_codes.count(0)))
+
+    return exit_code
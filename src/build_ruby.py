@@ -1,15 +1,23 @@
 import os
-import re
-import shutil
 import os.path as osp
+import glob
+import fnmatch
+import shutil
 import logging
+import tempfile
+import threading
+import contextlib
 from abc import ABCMeta
 import xml.etree.ElementTree as ET
-import yaml
 
 from . import utillib
 from . import confreader
+from . import cache
 from .logger import LogTaskStatus
+from .gemhome import GemHomeSnapshot, get_gem_home, get_gem_dirs, get_missing_gems, lock_gem_dirs
+from .gemmirror import GemMirror, get_locked_gems
+from .rubygem import GemFile, GemFileError, GemIndex, GemRequirement, GemVersion
+from .rubyenv import RubyEnv
 
 from .utillib import UnpackArchiveError
 from .utillib import NotADirectoryException
@@ -75,9 +83,11 @@ class BuildSummary(metaclass=ABCMeta):
 
         return elem
 
-    def __init__(self, build_root_dir, pkg_root_dir, pkg_conf):
+    def __init__(self, build_root_dir, pkg_root_dir, pkg_conf,
+                 env_layout=utillib.EnvironmentTable.INLINE):
 
         self._build_root_dir = build_root_dir
+        self._env_table = utillib.EnvironmentTable(env_layout)
         self._root = ET.Element('build-summary')
 
         pkg_conf_xml = BuildSummary._add(self._root, 'package-conf')
@@ -99,22 +109,23 @@ class BuildSummary(metaclass=ABCMeta):
         if value:
             logging.exception(value)
 
+        envs_xml = self._env_table.get_environments()
+        if envs_xml is not None:
+            self._root.append(envs_xml)
+
         tree = ET.ElementTree(self._root)
         build_summary_file = osp.join(self._build_root_dir, BuildSummary.FILENAME)
         tree.write(build_summary_file, encoding='UTF-8', xml_declaration=True)
 
     def add_command(self, cmd_type, executable, args,
                     exit_code, environ, working_dir,
-                    stdout_file, stderr_file):
+                    stdout_file, stderr_file, skip_reason=None):
 
         cmd_root_xml = BuildSummary._add(self._root, 'build-command')
         cmd_root_xml.set('type', cmd_type)
 
         BuildSummary._add(cmd_root_xml, 'cwd', working_dir)
-        environ_xml = BuildSummary._add(cmd_root_xml, 'environment')
-        for _env in environ.keys():
-            BuildSummary._add(environ_xml, 'env',
-                              '{0}={1}'.format(_env, environ[_env]))
+        self._env_table.add(cmd_root_xml, environ)
 
         BuildSummary._add(cmd_root_xml, 'executable', executable)
         args_xml = BuildSummary._add(cmd_root_xml, 'args')
@@ -126,6 +137,46 @@ class BuildSummary(metaclass=ABCMeta):
         BuildSummary._add(cmd_root_xml, 'stdout-file', stdout_file)
         BuildSummary._add(cmd_root_xml, 'stderr-file', stderr_file)
 
+        if skip_reason:
+            BuildSummary._add(cmd_root_xml, 'skip-reason', skip_reason)
+
+    @classmethod
+    def relocate(cls, build_summary_file, build_root_dir):
+        '''rewrites the build summary of a build directory moved to
+        build_root_dir, build-root-dir and the paths in it are changed from
+        the build directory the package was built in to build_root_dir'''
+
+        tree = ET.parse(build_summary_file)
+        root = tree.getroot()
+        old_build_root_dir = root.find('build-root-dir').text
+
+        if old_build_root_dir == build_root_dir:
+            return
+
+        for elem in root.iter():
+            if elem.text == old_build_root_dir:
+                elem.text = build_root_dir
+            elif elem.text and elem.text.startswith(old_build_root_dir + '/'):
+                elem.text = build_root_dir + elem.text[len(old_build_root_dir):]
+
+        tree.write(build_summary_file, encoding='UTF-8', xml_declaration=True)
+        logging.info('BUILD SUMMARY: relocated %s to %s', old_build_root_dir, build_root_dir)
+
+    @classmethod
+    def get_external_dependencies(cls, build_summary_file):
+        '''returns the dependency paths in the build summary that are not in
+        the build directory, such as the lib directories of installed gems'''
+
+        root = ET.parse(build_summary_file).getroot()
+        build_root_dir = root.find('build-root-dir').text
+
+        return [elem.text for elem in root.iterfind('build-artifacts/ruby-src/dependency/file')
+                if elem.text and osp.isabs(elem.text) and
+                not elem.text.startswith(build_root_dir + '/')]
+
+    def add_build_jobs(self, build_jobs):
+        BuildSummary._add(self._root, 'build-jobs', str(build_jobs))
+
     def add_exit_code(self, exit_code):
         if exit_code >= 0:
             BuildSummary._add(self._root, 'exit-code', str(exit_code))
@@ -135,8 +186,9 @@ class BuildSummary(metaclass=ABCMeta):
 
 class BuildSummaryRubyNoGem(BuildSummary):
 
-    def __init__(self, build_root_dir, pkg_root_dir, pkg_conf):
-        BuildSummary.__init__(self, build_root_dir, pkg_root_dir, pkg_conf)
+    def __init__(self, build_root_dir, pkg_root_dir, pkg_conf,
+                 env_layout=utillib.EnvironmentTable.INLINE):
+        BuildSummary.__init__(self, build_root_dir, pkg_root_dir, pkg_conf, env_layout)
         BuildSummary._add(self._root, 'package-dir', pkg_conf['package-dir'])
         self.build_root_dir = build_root_dir
 
@@ -146,24 +198,25 @@ class BuildSummaryRubyNoGem(BuildSummary):
         ruby_gem_xml = BuildSummary._add(build_artifacts_xml, 'ruby-src')
 
         ruby_src_xml = BuildSummary._add(ruby_gem_xml, 'include')
-        for _file in include:
+        for _file in sorted(include):
             filepath = osp.relpath(_file, self.build_root_dir)
             BuildSummary._add(ruby_src_xml, 'file', filepath)
 
         ruby_src_xml = BuildSummary._add(ruby_gem_xml, 'exclude')
-        for _file in exclude:
+        for _file in sorted(exclude):
             filepath = osp.relpath(_file, self.build_root_dir)
             BuildSummary._add(ruby_src_xml, 'file', filepath)
 
         ruby_dep_xml = BuildSummary._add(ruby_gem_xml, 'dependency')
-        for _file in libs:
+        for _file in sorted(libs):
             BuildSummary._add(ruby_dep_xml, 'file', _file)
 
 
 class BuildSummaryRubyGem(BuildSummary):
 
-    def __init__(self, build_root_dir, pkg_root_dir, pkg_conf):
-        BuildSummary.__init__(self, build_root_dir, pkg_root_dir, pkg_conf)
+    def __init__(self, build_root_dir, pkg_root_dir, pkg_conf,
+                 env_layout=utillib.EnvironmentTable.INLINE):
+        BuildSummary.__init__(self, build_root_dir, pkg_root_dir, pkg_conf, env_layout)
         self.build_root_dir = build_root_dir
         self.pkg_root_dir = pkg_root_dir
 
@@ -196,21 +249,57 @@ class RubyPkg(metaclass=ABCMeta):
     def __init__(self, pkg_conf_file, input_root_dir, build_root_dir):
         self._build_conf_extras = dict()
 
+        self.run_conf = utillib.get_run_conf(input_root_dir)
+
+        self.env_layout = self.run_conf.get('summary-env-layout',
+                                            utillib.EnvironmentTable.INLINE)
+
+        self.gem_mirror = GemMirror.get(self.run_conf)
+
+        # the paths the build adds or changes in GEM_HOME, for the build cache
+        self.gem_home_changes = None
+
     def build(self, build_root_dir):
         raise NotImplementedError()
 
-    @classmethod
-    def get_env(cls, pwd):
+    def lock_gem_dirs(self):
+        '''lock_gem_dirs() around the commands of the build that install
+        gems, the paths they add or change are added to gem_home_changes'''
+        return lock_gem_dirs(self.gem_home_changes)
+
+    def get_build_jobs(self):
+        '''build-jobs in package.conf, the number of CPUs by default'''
+
+        build_jobs = self.pkg_conf.get('build-jobs')
+
+        if build_jobs:
+            try:
+                if int(build_jobs) >= 1:
+                    return int(build_jobs)
+            except ValueError:
+                pass
+            logging.warning("Invalid build-jobs '%s' in package.conf", build_jobs)
+
+        return utillib.cpu_count()
+
+    def get_env(self, pwd, extra_env=None):
         new_env = dict(os.environ)
         if 'PWD' in new_env:
             new_env['PWD'] = pwd
 
+        # compile native extensions in parallel, unless make is
+        # already told how to by the environment
+        if 'MAKEFLAGS' not in new_env or self.pkg_conf.get('build-jobs'):
+            new_env['MAKEFLAGS'] = '-j{0}'.format(self.get_build_jobs())
+
+        if extra_env:
+            new_env.update(extra_env)
+
         return new_env
 
-    @classmethod
-    def run_cmd(cls, cmd, cwd, outfile, errfile, description, shell=False):
+    def run_cmd(self, cmd, cwd, outfile, errfile, description, shell=False, extra_env=None):
 
-        environ = RubyPkg.get_env(cwd)
+        environ = self.get_env(cwd, extra_env)
 
         logging.info('%s COMMAND %s', description, cmd)
 
@@ -228,6 +317,32 @@ class RubyPkg(metaclass=ABCMeta):
 
         return (exit_code, _environ)
 
+    @contextlib.contextmanager
+    def serve_gem_mirror(self, gem_files=()):
+        '''adds gem_files and the gems in the gem directory to the gem mirror,
+        and yields the URL it is served at, None without gem-mirror=true
+        in run.conf'''
+
+        if self.gem_mirror is None:
+            yield None
+            return
+
+        self.gem_mirror.add(gem_files)
+        self.gem_mirror.harvest(get_gem_home())
+
+        if self.gem_mirror.update_index() != 0:
+            logging.warning('GEM MIRROR: indexing failed, not using the mirror')
+            yield None
+            return
+
+        with self.gem_mirror.serve() as url:
+            yield url
+
+    def harvest_gem_mirror(self):
+        '''adds the gems the last command downloaded to the gem mirror'''
+        if self.gem_mirror is not None:
+            self.gem_mirror.harvest(get_gem_home())
+
     def add_build_conf_attr(self, name, value):
         self._build_conf_extras[name] = value
 
@@ -240,16 +355,31 @@ class RubySrc(RubyPkg, metaclass=ABCMeta):
 
     PKG_ROOT_DIRNAME = "pkg1"
 
+    # third party code, excluded with package-exclude-vendored=true
+    VENDORED_PATHS = [
+        'vendor/bundle/', 'vendor/cache/', 'vendor/ruby/',
+        '**/node_modules/', '**/bower_components/',
+        'tmp/', 'log/', 'coverage/', 'public/assets/', 'public/packs/',
+    ]
+
     def __init__(self, pkg_conf_file, input_root_dir, build_root_dir):
         RubyPkg.__init__(self, pkg_conf_file, input_root_dir, build_root_dir)
 
         self.pkg_conf = confreader.read_conf_into_dict(pkg_conf_file)
         logging.info('PACKAGE CONF: %s', self.pkg_conf)
 
+        # package-exclude-paths of files and directories not extracted
+        self._excluded_files = set()
+        self._excluded_paths = set()
+
         with LogTaskStatus('package-unarchive'):
             pkg_archive = osp.join(input_root_dir, self.pkg_conf['package-archive'])
             pkg_root_dir = osp.join(build_root_dir, RubyNoBuild.PKG_ROOT_DIRNAME)
-            status = utillib.unpack_archive(pkg_archive, pkg_root_dir, True)
+            # the build writes in the package directory, the files are copied
+            status = utillib.unpack_archive(pkg_archive, pkg_root_dir, True,
+                                            unpack_cache=cache.get_cache('unpack', self.run_conf),
+                                            copy=True,
+                                            select=self._get_extract_filter())
 
             if status != 0:
                 raise UnpackArchiveError(osp.basename(pkg_archive))
@@ -263,33 +393,60 @@ class RubySrc(RubyPkg, metaclass=ABCMeta):
 
             self.pkg_dir = pkg_dir
 
+    def _get_extract_filter(self):
+        '''returns a function that selects the archive members to extract,
+        None to extract all of them'''
+        return None
+
+    def _get_exclude_matcher(self, exclude_str):
+        '''PathMatcher of the comma separated patterns in exclude_str, after
+        VENDORED_PATHS with package-exclude-vendored=true in package.conf'''
+
+        patterns = list()
+        if utillib.string_to_bool(self.pkg_conf.get('package-exclude-vendored', 'false')):
+            patterns.extend(RubySrc.VENDORED_PATHS)
+
+        if exclude_str:
+            patterns.extend(xpath for xpath in exclude_str.split(',') if xpath.strip())
+
+        return utillib.PathMatcher(patterns)
+
     def _get_files(self, exclude_str):
         include = set()
         exclude = set()
-        exclude_dir = set()
         dirs = set()
 
-        if exclude_str:
-            for xpath in exclude_str.split(','):
-                if xpath.strip():
-                    if osp.isdir(osp.join(self.pkg_dir, xpath)):
-                        exclude_dir.add(osp.join(self.pkg_dir, xpath))
-                    elif osp.isfile(osp.join(self.pkg_dir, xpath)):
-                        exclude.add(osp.join(self.pkg_dir, xpath))
-                    else:
-                        logging.warning('Exclude path %s not found',
-                                        osp.join(self.pkg_dir, xpath))
-
+        matcher = self._get_exclude_matcher(exclude_str)
 
-        for dirpath, _, filenames in utillib.os_walk(self.pkg_dir, exclude_dir):
+        if exclude_str:
+            for xpath in utillib.PathMatcher(exclude_str.split(',')).get_literals():
+                if not matcher.match(xpath):
+                    continue
+                elif osp.isfile(osp.join(self.pkg_dir, xpath)):
+                    exclude.add(osp.join(self.pkg_dir, xpath))
+                elif xpath in self._excluded_files:
+                    # not extracted from the package archive
+                    exclude.add(osp.join(self.pkg_dir, xpath))
+                elif not osp.isdir(osp.join(self.pkg_dir, xpath)) and \
+                     xpath not in self._excluded_paths:
+                    logging.warning('Exclude path %s not found',
+                                    osp.join(self.pkg_dir, xpath))
+
+        for dirpath, _, filenames in utillib.os_walk(self.pkg_dir, None, matcher):
             rb_files = {osp.join(dirpath, _file) for _file in filenames \
                         if osp.splitext(_file)[1] == '.rb'}
             if rb_files:
-                if dirpath not in exclude_dir:
-                    include.update(rb_files)
-                    dirs.add(dirpath)
-                else:
-                    exclude.update(rb_files)
+                dirs.add(dirpath)
+                for rb_file in rb_files:
+                    if matcher.match(osp.relpath(rb_file, self.pkg_dir)):
+                        exclude.add(rb_file)
+                    else:
+                        include.add(rb_file)
+
+        # ruby files excluded when the package archive was extracted
+        exclude.update(osp.join(self.pkg_dir, xpath) for xpath in self._excluded_files
+                       if osp.splitext(xpath)[1] == '.rb' and
+                       not any(name.startswith('.') for name in xpath.split(os.sep)))
 
         include.difference_update(exclude)
         return (include, exclude, dirs)
@@ -319,11 +476,11 @@ class RubySrc(RubyPkg, metaclass=ABCMeta):
                 self.add_build_conf_attr('config-stdout-file', config_stdout)
                 self.add_build_conf_attr('config-stderr-file', config_stderr)
 
-                (exit_code, environ) = RubyPkg.run_cmd(config_cmd,
-                                                       config_dir,
-                                                       outfile,
-                                                       errfile,
-                                                       "CONFIGURE")
+                (exit_code, environ) = self.run_cmd(config_cmd,
+                                                    config_dir,
+                                                    outfile,
+                                                    errfile,
+                                                    "CONFIGURE")
 
                 build_summary.add_command('configure',
                                           config_cmd,
@@ -351,19 +508,74 @@ class RubyBundlerRake(RubySrc):
     def __init__(self, pkg_conf_file, input_root_dir, build_root_dir):
         RubySrc.__init__(self, pkg_conf_file, input_root_dir, build_root_dir)
 
+    def _get_bundled_with(self):
+        '''returns the bundler version in the BUNDLED WITH section of
+        Gemfile.lock, None if there is none'''
+
+        lock_file = osp.join(self.pkg_dir, 'Gemfile.lock')
+        if not osp.isfile(lock_file):
+            return None
+
+        with open(lock_file) as fobj:
+            lines = [line.strip() for line in fobj]
+
+        if 'BUNDLED WITH' in lines:
+            index = lines.index('BUNDLED WITH') + 1
+            if index < len(lines) and lines[index]:
+                return lines[index]
+
+        return None
+
     @classmethod
-    def _install_bundler(cls, build_root_dir, build_summary):
+    def _find_bundler(cls, bundled_with):
+        '''returns an installed bundler that can install a Gemfile.lock
+        BUNDLED WITH bundled_with, a later version with the same major
+        version, any bundler if bundled_with is None'''
+
+        if bundled_with:
+            major = GemVersion(bundled_with).release().segments[:1] or [0]
+            requirement = GemRequirement(['>= ' + bundled_with,
+                                          '< {0}'.format(major[0] + 1)])
+        else:
+            requirement = None
+
+        return GemIndex.get(get_gem_dirs(), default_gems=True).find('bundler', requirement)
+
+    def _install_bundler(self, build_root_dir, build_summary):
+
+        bundled_with = self._get_bundled_with()
 
         gem_install_cmd = ['gem', 'install', '--no-document', 'bundler']
+        if bundled_with:
+            gem_install_cmd.extend(['--version', bundled_with])
+
+        bundler = RubyBundlerRake._find_bundler(bundled_with)
+
+        if bundler is not None:
+            skip_reason = 'bundler {0} is installed in {1}{2}'.format(
+                bundler.version, bundler.gem_dir,
+                ', Gemfile.lock is bundled with {0}'.format(bundled_with) if bundled_with else '')
+            logging.info('INSTALL BUNDLER SKIPPED: %s', skip_reason)
+
+            build_summary.add_command('install-bundler', gem_install_cmd[0],
+                                      gem_install_cmd[1:], 0,
+                                      self.get_env(build_root_dir),
+                                      build_root_dir,
+                                      None, None, skip_reason)
+            return
 
         outfile = osp.join(build_root_dir, 'install_bundler_gem.out')
         errfile = osp.join(build_root_dir, 'install_bundler_gem.err')
 
-        (exit_code, environ) = RubyPkg.run_cmd(gem_install_cmd,
-                                               build_root_dir,
-                                               outfile,
-                                               errfile,
-                                               "INSTALL BUNDLER")
+        with self.serve_gem_mirror() as mirror_url:
+            if mirror_url:
+                gem_install_cmd[3:3] = self.gem_mirror.get_gem_source_args(mirror_url)
+
+            (exit_code, environ) = self.run_cmd(gem_install_cmd,
+                                                build_root_dir,
+                                                outfile,
+                                                errfile,
+                                                "INSTALL BUNDLER")
 
         build_summary.add_command('install-bundler', gem_install_cmd[0],
                                   gem_install_cmd[1:], exit_code, environ,
@@ -377,39 +589,144 @@ class RubyBundlerRake(RubySrc):
                                      osp.relpath(outfile, build_root_dir),
                                      osp.relpath(errfile, build_root_dir))
 
+        self.harvest_gem_mirror()
+
+    def _get_bundle_cache_key(self, gem_home):
+        '''digest of Gemfile.lock, the ruby version and platform, the gem
+        directory and the bundler settings in the environment, None if
+        the package has no Gemfile.lock'''
+
+        lock_file = osp.join(self.pkg_dir, 'Gemfile.lock')
+        if not osp.isfile(lock_file):
+            return None
+
+        ruby_env = RubyEnv.get()
+        key_data = [utillib.file_digest(lock_file),
+                    ruby_env['ruby-version'],
+                    ruby_env['ruby-platform'],
+                    gem_home]
+        key_data.extend('{0}={1}'.format(key, os.environ[key])
+                        for key in sorted(os.environ) if key.startswith('BUNDLE_'))
+
+        return utillib.string_digest('\n'.join(key_data))
+
+    def _get_bundle_jobs_args(self):
+        '''install gems in parallel, and retry failed downloads'''
+        return ['--jobs', str(self.get_build_jobs()), '--retry', '3']
+
+    def _run_bundle_install(self, bundle_install_cmd, build_root_dir, build_summary,
+                            extra_env=None):
+
+        outfile = osp.join(build_root_dir, 'bundle_install.out')
+        errfile = osp.join(build_root_dir, 'bundle_install.err')
+
+        (exit_code, environ) = self.run_cmd(bundle_install_cmd,
+                                            self.pkg_dir,
+                                            outfile,
+                                            errfile,
+                                            "'bundle install'",
+                                            extra_env=extra_env)
+
+        build_summary.add_command('bundle-install', bundle_install_cmd[0],
+                                  bundle_install_cmd[1:], exit_code, environ,
+                                  environ['PWD'],
+                                  outfile, errfile)
+
+        return (exit_code, outfile, errfile)
+
+    def _bundle_install(self, build_root_dir, build_summary):
+        '''runs bundle install. With bundle-cache=true in run.conf, the gems it
+        installs are saved in the cache keyed by Gemfile.lock, and restored
+        from there on the next build of the same Gemfile.lock, then
+        bundle install --local checks that the bundle is complete'''
+
+        bundle_cache = cache.get_cache('bundle', self.run_conf)
+        gem_home = get_gem_home()
+        cache_key = self._get_bundle_cache_key(gem_home) if bundle_cache else None
+        snapshot = GemHomeSnapshot(gem_home) if cache_key else None
+        locked_gems = get_locked_gems(osp.join(self.pkg_dir, 'Gemfile.lock'))
+        entry_dir = None
+
+        if cache_key:
+            # not removed by the gc of another process while it is restored
+            with bundle_cache.lock(cache_key):
+                entry_dir = bundle_cache.get(cache_key)
+                if entry_dir:
+                    GemHomeSnapshot.restore(entry_dir, gem_home)
+
+        if entry_dir:
+            # the entry holds only the gems that were not installed when it
+            # was saved, the others may have been removed since
+            missing = get_missing_gems(locked_gems or [])
+            if missing:
+                logging.warning('BUNDLE CACHE: not installed: %s', ' '.join(missing))
+                exit_code = None
+            else:
+                (exit_code, _, _) = self._run_bundle_install(['bundle', 'install', '--local'] +
+                                                             self._get_bundle_jobs_args(),
+                                                             build_root_dir, build_summary)
+            if exit_code == 0:
+                logging.info('BUNDLE CACHE: restored %s', entry_dir)
+                return
+
+            if exit_code is not None:
+                logging.warning('BUNDLE CACHE: bundle install --local failed with %s',
+                                entry_dir)
+            bundle_cache.remove(cache_key)
+
+        vendor_gems = glob.glob(osp.join(self.pkg_dir, 'vendor', 'cache', '*.gem'))
+
+        bundle_install_cmd = ['bundle', 'install'] + self._get_bundle_jobs_args()
+        with self.serve_gem_mirror(vendor_gems) as mirror_url:
+            # without the internet, the gems bundler cannot find in the mirror
+            # cannot be found anywhere else either
+            if mirror_url and (self.gem_mirror.offline or
+                               (locked_gems and self.gem_mirror.has_gems(locked_gems))):
+                mirror_env = self.gem_mirror.get_bundle_env(mirror_url)
+            else:
+                mirror_env = None
+
+            (exit_code, outfile, errfile) = self._run_bundle_install(bundle_install_cmd,
+                                                                     build_root_dir,
+                                                                     build_summary,
+                                                                     mirror_env)
+
+        if exit_code != 0:
+            build_summary.add_exit_code(exit_code)
+            raise CommandFailedError(bundle_install_cmd, exit_code,
+                                     BuildSummary.FILENAME,
+                                     osp.relpath(outfile, build_root_dir),
+                                     osp.relpath(errfile, build_root_dir))
+
+        self.harvest_gem_mirror()
+
+        if snapshot:
+            paths = snapshot.diff()
+            if paths:
+                try:
+                    bundle_cache.put(cache_key, lambda dirpath: snapshot.save(paths, dirpath))
+                    bundle_cache.gc()
+                    logging.info('BUNDLE CACHE: saved %d files', len(paths))
+                except OSError as err:
+                    logging.warning('BUNDLE CACHE: %s', err)
+
     def build(self, build_root_dir):
 
         with BuildSummaryRubyNoGem(build_root_dir,
                                    RubyGem.PKG_ROOT_DIRNAME,
-                                   self.pkg_conf) as build_summary:
+                                   self.pkg_conf,
+                                   self.env_layout) as build_summary:
+
+            build_summary.add_build_jobs(self.get_build_jobs())
 
             self._configure(build_root_dir, build_summary)
 
             with LogTaskStatus('build'):
 
-                RubyBundlerRake._install_bundler(build_root_dir, build_summary)
-
-                bundle_install_cmd = ['bundle', 'install']
-                outfile = osp.join(build_root_dir, 'bundle_install.out')
-                errfile = osp.join(build_root_dir, 'bundle_install.err')
-
-                (exit_code, environ) = RubyPkg.run_cmd(bundle_install_cmd,
-                                                       self.pkg_dir,
-                                                       outfile,
-                                                       errfile,
-                                                       "'bundle install'")
-
-                build_summary.add_command('bundle-install', bundle_install_cmd[0],
-                                          bundle_install_cmd[1:], exit_code, environ,
-                                          environ['PWD'],
-                                          outfile, errfile)
+                with self.lock_gem_dirs():
+                    self._install_bundler(build_root_dir, build_summary)
 
-                if exit_code != 0:
-                    build_summary.add_exit_code(exit_code)
-                    raise CommandFailedError(bundle_install_cmd, exit_code,
-                                             BuildSummary.FILENAME,
-                                             osp.relpath(outfile, build_root_dir),
-                                             osp.relpath(errfile, build_root_dir))
+                    self._bundle_install(build_root_dir, build_summary)
 
                 if self.pkg_conf['build-sys'].endswith('+rake'):
 
@@ -431,11 +748,11 @@ class RubyBundlerRake(RubySrc):
                     self.add_build_conf_attr('build-stdout-file', build_stdout)
                     self.add_build_conf_attr('build-stderr-file', build_stderr)
 
-                    (exit_code, environ) = RubyPkg.run_cmd(build_cmd,
-                                                           pkg_build_dir,
-                                                           outfile,
-                                                           errfile,
-                                                           "'rake'")
+                    (exit_code, environ) = self.run_cmd(build_cmd,
+                                                        pkg_build_dir,
+                                                        outfile,
+                                                        errfile,
+                                                        "'rake'")
 
                     build_summary.add_command('rake', build_cmd,
                                               [], exit_code, environ,
@@ -464,11 +781,11 @@ class RubyBundlerRake(RubySrc):
                     self.add_build_conf_attr('build-stdout-file', build_stdout)
                     self.add_build_conf_attr('build-stderr-file', build_stderr)
 
-                    (exit_code, environ) = RubyPkg.run_cmd(build_cmd,
-                                                           pkg_build_dir,
-                                                           outfile,
-                                                           errfile,
-                                                           "'rake'")
+                    (exit_code, environ) = self.run_cmd(build_cmd,
+                                                        pkg_build_dir,
+                                                        outfile,
+                                                        errfile,
+                                                        "'rake'")
 
                     build_summary.add_command('rake', build_cmd,
                                               [], exit_code, environ,
@@ -546,7 +863,10 @@ class RubyRake(RubySrc):
 
         with BuildSummaryRubyNoGem(build_root_dir,
                                    RubyGem.PKG_ROOT_DIRNAME,
-                                   self.pkg_conf) as build_summary:
+                                   self.pkg_conf,
+                                   self.env_layout) as build_summary:
+
+            build_summary.add_build_jobs(self.get_build_jobs())
 
             self._configure(build_root_dir, build_summary)
 
@@ -561,11 +881,11 @@ class RubyRake(RubySrc):
                 self.add_build_conf_attr('build-stdout-file', build_stdout)
                 self.add_build_conf_attr('build-stderr-file', build_stderr)
 
-                (exit_code, environ) = RubyPkg.run_cmd(build_cmd,
-                                                       pkg_build_dir,
-                                                       outfile,
-                                                       errfile,
-                                                       'rake')
+                (exit_code, environ) = self.run_cmd(build_cmd,
+                                                    pkg_build_dir,
+                                                    outfile,
+                                                    errfile,
+                                                    'rake')
 
                 build_summary.add_command('rake', build_cmd,
                                           [], exit_code, environ,
@@ -598,14 +918,55 @@ class RubyRake(RubySrc):
 
 class RubyNoBuild(RubySrc):
 
+    # files assessed or read by the tools, with selective-extract=true
+    # only these are extracted from the package archive
+    SELECTIVE_EXTRACT_PATTERNS = [
+        '*.rb', '*.rake', '*.ru', '*.gemspec', 'Rakefile',
+        'Gemfile', 'Gemfile.lock', 'gems.rb', 'gems.locked',
+        '*.erb', '*.rhtml', '*.haml', '*.slim', '*.builder', '*.jbuilder',
+        '*.yml', '*.yaml', '*.reek', '.ruby-version',
+    ]
+
     def __init__(self, pkg_conf_file, input_root_dir, build_root_dir):
         RubySrc.__init__(self, pkg_conf_file, input_root_dir, build_root_dir)
 
+    def _get_extract_filter(self):
+        '''with selective-extract=true in run.conf, selects the files in the
+        package directory that match SELECTIVE_EXTRACT_PATTERNS and are not
+        excluded by package-exclude-paths'''
+
+        if not utillib.string_to_bool(self.run_conf.get('selective-extract', 'false')):
+            return None
+
+        pkg_dir = osp.normpath(self.pkg_conf['package-dir'])
+        matcher = self._get_exclude_matcher(self.pkg_conf.get('package-exclude-paths'))
+
+        def select(name):
+            path = osp.relpath(osp.normpath(name), pkg_dir)
+            if path == '..' or path.startswith('..' + os.sep):
+                return False
+
+            if matcher:
+                pruned = matcher.prunes_parent(path)
+                if pruned is not None:
+                    self._excluded_paths.add(pruned)
+                    return False
+                elif matcher.match(path):
+                    self._excluded_files.add(path)
+                    return False
+
+            filename = osp.basename(path)
+            return any(fnmatch.fnmatchcase(filename, pattern)
+                       for pattern in RubyNoBuild.SELECTIVE_EXTRACT_PATTERNS)
+
+        return select
+
     def build(self, build_root_dir):
 
         with BuildSummaryRubyNoGem(build_root_dir,
                                    RubyGem.PKG_ROOT_DIRNAME,
-                                   self.pkg_conf) as build_summary:
+                                   self.pkg_conf,
+                                   self.env_layout) as build_summary:
 
             with LogTaskStatus('build'):
 
@@ -629,10 +990,10 @@ class RubyGem(RubyPkg):
     '''Class to handle RubyGems'''
 
     # Install the gem check for errors 'gem install <path to XXX.gem> --user-install'
-    # Read the spec 'gem spec <path to XXX.gem> --yaml > XXX.yaml'
-    # Rewrite the yaml without Ruby class info re.compile(':\s+!ruby/object:Gem::.+$')
-    # yaml.load('XXX.yamlnoruby') and get version, name, platform, dependencies, files
-    # Unpack the gem in build/pkg1
+    # Read the spec from metadata.gz in XXX.gem, objects with Ruby class info
+    # are loaded as dicts, and get version, name, platform, dependencies, files
+    # Unpack data.tar.gz in XXX.gem in build/pkg1/<name>-<version>
+    # Both are recorded in build_summary.xml as the gem commands they replace
     # Write build_summary.xml
 
     PKG_ROOT_DIRNAME = "pkg1"
@@ -644,42 +1005,81 @@ class RubyGem(RubyPkg):
         self.pkg_conf = confreader.read_conf_into_dict(pkg_conf_file)
         self.gem_file = osp.join(input_root_dir, self.pkg_conf['package-archive'])
 
-    @classmethod
-    def rm_ruby_code(cls, filename):
-        '''remove ruby object specific code from specification file'''
-        regex = re.compile('!ruby/object:Gem::.+$')
-        new_file = filename + '-modified'
-
-        with open(filename) as fobj:
-            with open(new_file, 'w') as new_fobj:
-                for line in fobj:
-                    newline = regex.sub('', line)
-                    new_fobj.write(newline)
-
-        return new_file
-
     @classmethod
     def get_dependencies(cls, gem_spec):
+        '''returns the lib directories of the installed gem and of the
+        installed gems that satisfy its runtime dependencies, transitively'''
 
-        gem_user_dir = osp.join(os.getenv(RubyGem.GEM_HOME), 'gems')
+        gem_dirs = get_gem_dirs()
+        gem_index = GemIndex.get(gem_dirs)
         user_dependencies = []
 
-        gem_dir = '{0}-{1}'.format(gem_spec['name'], gem_spec['version']['version'])
-        user_dependencies.append(osp.join(osp.join(gem_user_dir, gem_dir), 'lib'))
+        gem = gem_index.find(gem_spec['name'],
+                             GemRequirement([gem_spec['version']['version']]))
+        if gem is not None:
+            user_dependencies.extend(gem.get_lib_dirs())
+        elif gem_dirs:
+            gem_dir = '{0}-{1}'.format(gem_spec['name'], gem_spec['version']['version'])
+            user_dependencies.append(osp.join(gem_dirs[0], 'gems', gem_dir, 'lib'))
+
+        spec_dependencies = list()
+        for dep in gem_spec.get('dependencies') or []:
+            if dep.get('type') == ':development':
+                continue
+
+            requirements = dep.get('requirement', dict()).get('requirements', [])
+            constraints = ['{0} {1}'.format(op, version['version'])
+                           for (op, version) in requirements]
+            spec_dependencies.append((dep['name'], GemRequirement(constraints)))
 
-        spec_dependencies = [dep['name'] for dep in gem_spec['dependencies']]
-        for spec_dep in sorted(spec_dependencies):
-            for gem in os.listdir(gem_user_dir):
-                if gem.startswith(spec_dep + '-'):
-                    user_dependencies.append(osp.join(osp.join(gem_user_dir, gem), 'lib'))
+        for dep_gem in gem_index.resolve(spec_dependencies):
+            if dep_gem.name != gem_spec['name']:
+                user_dependencies.extend(dep_gem.get_lib_dirs())
 
         return user_dependencies
 
+    def _read_gem_file(self, cmd_type, cmd, read, build_root_dir, build_summary):
+        '''calls read(), which reads the .gem file in process as cmd did, and
+        records it in the build summary as cmd, the reason of a failure is
+        in its stderr file. Returns the result of read(), raises
+        GemFileError with the build summary file if it fails'''
+
+        outfile = osp.join(build_root_dir, cmd_type.replace('-', '_') + '.out')
+        errfile = osp.join(build_root_dir, cmd_type.replace('-', '_') + '.err')
+
+        try:
+            result = read()
+            error = None
+        except GemFileError as err:
+            result = None
+            error = err
+
+        exit_code = error.exit_code if error else 0
+
+        with open(outfile, 'w'), open(errfile, 'w') as fobj:
+            if error:
+                fobj.write(str(error) + '\n')
+
+        build_summary.add_command(cmd_type, cmd[0], cmd[1:], exit_code,
+                                  self.get_env(build_root_dir), build_root_dir,
+                                  outfile, errfile,
+                                  skip_reason='read in process by ruby-assess')
+
+        if error:
+            build_summary.add_exit_code(exit_code)
+            error.build_summary_file = BuildSummary.FILENAME
+            raise error
+
+        return result
+
     def build(self, build_root_dir):
 
         with BuildSummaryRubyGem(build_root_dir,
                                  RubyGem.PKG_ROOT_DIRNAME,
-                                 self.pkg_conf) as build_summary:
+                                 self.pkg_conf,
+                                 self.env_layout) as build_summary:
+
+            build_summary.add_build_jobs(self.get_build_jobs())
 
             pkg_root_dir = osp.join(build_root_dir, RubyGem.PKG_ROOT_DIRNAME)
             if not osp.isdir(pkg_root_dir):
@@ -687,18 +1087,21 @@ class RubyGem(RubyPkg):
 
             with LogTaskStatus('gem-install'):
 
-                gem_install_cmd = ['gem', 'install',
-                                   '--no-document',
-                                   self.gem_file]
-
                 outfile = osp.join(build_root_dir, 'gem_install.out')
                 errfile = osp.join(build_root_dir, 'gem_install.err')
 
-                (exit_code, environ) = RubyPkg.run_cmd(gem_install_cmd,
-                                                       build_root_dir,
-                                                       outfile,
-                                                       errfile,
-                                                       "GEM INSTALL")
+                with self.lock_gem_dirs(), \
+                        self.serve_gem_mirror([self.gem_file]) as mirror_url:
+                    gem_install_cmd = ['gem', 'install', '--no-document']
+                    if mirror_url:
+                        gem_install_cmd.extend(self.gem_mirror.get_gem_source_args(mirror_url))
+                    gem_install_cmd.append(self.gem_file)
+
+                    (exit_code, environ) = self.run_cmd(gem_install_cmd,
+                                                        build_root_dir,
+                                                        outfile,
+                                                        errfile,
+                                                        "GEM INSTALL")
 
                 build_summary.add_command('gem-install', gem_install_cmd[0],
                                           gem_install_cmd[1:], exit_code, environ,
@@ -712,59 +1115,16 @@ class RubyGem(RubyPkg):
                                              osp.relpath(outfile, build_root_dir),
                                              osp.relpath(errfile, build_root_dir))
 
-            with LogTaskStatus('gem-unpack'):
-
-                gem_unpack_cmd = 'gem unpack %s --target %s' % (self.gem_file,
-                                                                pkg_root_dir)
-
-                outfile = osp.join(build_root_dir, 'gem_unpack.out')
-                errfile = osp.join(build_root_dir, 'gem_unpack.err')
+                self.harvest_gem_mirror()
 
-                (exit_code, environ) = RubyPkg.run_cmd(gem_unpack_cmd,
-                                                       build_root_dir,
-                                                       outfile,
-                                                       errfile,
-                                                       "GEM UNPACK")
-
-                build_summary.add_command('gem-unpack', gem_unpack_cmd,
-                                          [], exit_code, environ,
-                                          build_root_dir, outfile, errfile)
-
-                if exit_code != 0:
-                    build_summary.add_exit_code(exit_code)
-                    raise CommandFailedError(gem_unpack_cmd, exit_code,
-                                             BuildSummary.FILENAME,
-                                             osp.relpath(outfile, build_root_dir),
-                                             osp.relpath(errfile, build_root_dir))
+            gem_file = GemFile(self.gem_file)
 
             with LogTaskStatus('read-gem-spec'):
 
-                gem_spec_cmd = ['gem', 'specification', self.gem_file, '--yaml']
-
-                outfile = osp.join(build_root_dir,
-                                   osp.splitext(osp.basename(self.gem_file))[0] + '.yaml')
-                errfile = osp.join(build_root_dir,
-                                   osp.splitext(osp.basename(self.gem_file))[0] + '-spec.err')
-
-                (exit_code, environ) = RubyPkg.run_cmd(gem_spec_cmd,
-                                                       build_root_dir,
-                                                       outfile,
-                                                       errfile,
-                                                       "GEM UNPACK")
-
-                build_summary.add_command('read-gem-spec', gem_spec_cmd[0],
-                                          gem_spec_cmd[1:], exit_code, environ,
-                                          build_root_dir, outfile, errfile)
-
-                if exit_code != 0:
-                    build_summary.add_exit_code(exit_code)
-                    raise CommandFailedError(gem_spec_cmd, exit_code,
-                                             BuildSummary.FILENAME,
-                                             osp.relpath(outfile, build_root_dir),
-                                             osp.relpath(errfile, build_root_dir))
-
-                with open(RubyGem.rm_ruby_code(outfile)) as fobj:
-                    gem_spec = yaml.load(fobj)
+                gem_spec = self._read_gem_file('read-gem-spec',
+                                               ['gem', 'specification', self.gem_file, '--yaml'],
+                                               gem_file.read_spec,
+                                               build_root_dir, build_summary)
 
                 if 'files' not in gem_spec.keys():
                     raise EmptyPackageError("{0}-{1}".format(gem_spec['name'],
@@ -782,11 +1142,18 @@ class RubyGem(RubyPkg):
 
                 depenencies = RubyGem.get_dependencies(gem_spec)
 
-                build_summary.add_exit_code(exit_code)
-                build_summary.add_build_artifacts(gem_spec['name'],
-                                                  gem_spec['version']['version'],
-                                                  gem_spec['platform'],
-                                                  src_files, depenencies)
+            with LogTaskStatus('gem-unpack'):
+                gem_dir = '{0}-{1}'.format(gem_spec['name'], gem_spec['version']['version'])
+                self._read_gem_file('gem-unpack',
+                                    ['gem', 'unpack', self.gem_file, '--target', pkg_root_dir],
+                                    lambda: gem_file.extract(osp.join(pkg_root_dir, gem_dir)),
+                                    build_root_dir, build_summary)
+
+            build_summary.add_exit_code(exit_code)
+            build_summary.add_build_artifacts(gem_spec['name'],
+                                              gem_spec['version']['version'],
+                                              gem_spec['platform'],
+                                              src_files, depenencies)
 
         return (exit_code, BuildSummary.FILENAME)
 
@@ -819,7 +1186,281 @@ def get_pkg_obj(pkg_conf_file, input_root_dir, build_root_dir):
         raise NotImplementedError("Unknown build system '{0}'".format(build_sys))
 
 
-def build(input_root_dir, output_root_dir, build_root_dir):
+class BuildArchive:
+    '''Writes build.tar.gz of the build directory, then build.conf.
+    start() takes a snapshot of the build directory, a copy that shares the
+    blocks of the files where the file system can, and writes the archive
+    of the snapshot in a thread, so that the build directory can be
+    assessed in the meantime'''
+
+    _running = list()
+    _running_lock = threading.Lock()
+
+    def __init__(self, input_root_dir, output_root_dir, build_root_dir,
+                 build_conf, build_conf_extras):
+        self.input_root_dir = input_root_dir
+        self.output_root_dir = output_root_dir
+        self.build_root_dir = build_root_dir
+        self.build_conf = build_conf
+        self.build_conf_extras = build_conf_extras
+        self.on_written = None
+        self.error = None
+        self._thread = None
+
+    def _snapshot(self):
+        '''returns the directory with a snapshot of the build directory
+        under the same name, in the parent of the build directory so that
+        the files can be reflinked. The files are copied, hard links would
+        change with the build directory while the archive is written'''
+
+        snapshot_root_dir = tempfile.mkdtemp(prefix='.build-snapshot-',
+                                             dir=osp.dirname(self.build_root_dir))
+        utillib.copy_tree(self.build_root_dir,
+                          osp.join(snapshot_root_dir, osp.basename(self.build_root_dir)))
+        return snapshot_root_dir
+
+    def write(self, root_dir=None):
+        '''writes the archive of build_root_dir in root_dir (default: the
+        parent of build_root_dir), then build.conf, then calls
+        on_written(build_dir) if set'''
+
+        with LogTaskStatus('build-archive'):
+            run_conf = utillib.get_run_conf(self.input_root_dir)
+            build_archive = utillib.make_archive(osp.join(self.output_root_dir, 'build'),
+                                                 root_dir or osp.dirname(self.build_root_dir),
+                                                 osp.basename(self.build_root_dir),
+                                                 utillib.get_archive_level(run_conf))
+
+            self.build_conf['build-archive'] = osp.basename(build_archive)
+            self.build_conf['build-dir'] = osp.basename(self.build_root_dir)
+            self.build_conf.update(self.build_conf_extras)
+
+            utillib.write_to_file(osp.join(self.output_root_dir, 'build.conf'), self.build_conf)
+
+        if self.on_written:
+            # the build directory the archive was made of
+            self.on_written(osp.join(root_dir or osp.dirname(self.build_root_dir),
+                                     osp.basename(self.build_root_dir)))
+
+    def _run(self, snapshot_root_dir):
+        try:
+            self.write(snapshot_root_dir)
+        except BaseException as err:
+            logging.exception(err)
+            self.error = err
+        finally:
+            shutil.rmtree(snapshot_root_dir, ignore_errors=True)
+
+    def start(self):
+        snapshot_root_dir = self._snapshot()
+        self._thread = threading.Thread(target=self._run,
+                                        args=(snapshot_root_dir,),
+                                        name='build-archive')
+        self._thread.start()
+
+        with BuildArchive._running_lock:
+            BuildArchive._running.append(self)
+
+    @classmethod
+    def join_all(cls):
+        with cls._running_lock:
+            (running, cls._running) = (cls._running, list())
+
+        for build_archive in running:
+            build_archive._thread.join()
+
+        for build_archive in running:
+            if build_archive.error is not None:
+                raise build_archive.error
+
+
+def unarchive_build(input_root_dir, build_root_dir):
+    '''unpacks the build archive named in build.conf in input_root_dir as
+    build_root_dir to assess a package built by an earlier run, returns
+    (exit_code, build_summary_file) of that build. The installed gems the
+    build depends on are not in the archive, the exit code is 1 if they
+    are not installed here'''
+
+    build_conf_file = osp.join(input_root_dir, 'build.conf')
+    build_conf = confreader.read_conf_into_dict(build_conf_file)
+
+    if int(build_conf['exit-code']) != 0:
+        return (int(build_conf['exit-code']), None)
+
+    build_archive = osp.join(input_root_dir, build_conf['build-archive'])
+
+    with LogTaskStatus('build-unarchive') as status_dot_out:
+        if osp.isdir(build_root_dir) and os.listdir(build_root_dir):
+            status_dot_out.update_task_status(1, 'build directory not empty',
+                                              "Build directory '{0}' is not empty".format(
+                                                  build_root_dir))
+            return (1, None)
+
+        if osp.isdir(build_root_dir):
+            os.rmdir(build_root_dir)
+
+        unpack_dir = tempfile.mkdtemp(prefix='.build-unarchive-',
+                                      dir=osp.dirname(build_root_dir))
+        try:
+            run_conf = utillib.get_run_conf(input_root_dir)
+            status = utillib.unpack_archive(build_archive, unpack_dir,
+                                            unpack_cache=cache.get_cache('unpack', run_conf),
+                                            copy=True)
+            if status != 0:
+                status_dot_out.update_task_status(status, osp.basename(build_archive))
+                return (status, None)
+
+            os.rename(osp.join(unpack_dir, build_conf['build-dir']), build_root_dir)
+        finally:
+            shutil.rmtree(unpack_dir, ignore_errors=True)
+
+        build_summary_file = osp.join(build_root_dir, build_conf['build-summary-file'])
+        BuildSummary.relocate(build_summary_file, build_root_dir)
+
+        missing = [path for path in BuildSummary.get_external_dependencies(build_summary_file)
+                   if not osp.exists(path)]
+        if missing:
+            status_dot_out.update_task_status(1, 'dependencies not found',
+                                              'Not found, the build used another GEM_HOME:\n' +
+                                              '\n'.join(missing))
+            return (1, build_summary_file)
+
+    return (0, build_summary_file)
+
+def _get_build_cache_key(input_root_dir, build_root_dir, run_conf):
+    '''digest of the package archive, package.conf, the run.conf settings
+    that change the build, the ruby version and platform, the gem
+    directory and the name of the build directory, which is the top
+    directory in the build archive'''
+
+    pkg_conf = confreader.read_conf_into_dict(osp.join(input_root_dir, 'package.conf'))
+    ruby_env = RubyEnv.get()
+
+    key_data = [utillib.file_digest(osp.join(input_root_dir, pkg_conf['package-archive']))]
+    key_data.extend('{0}={1}'.format(key, pkg_conf[key]) for key in sorted(pkg_conf))
+    key_data.extend('{0}={1}'.format(key, run_conf.get(key, ''))
+                    for key in ['internet-inaccessible',
+                                'selective-extract',
+                                'summary-env-layout'])
+    key_data.extend([ruby_env['ruby-version'],
+                     ruby_env['ruby-platform'],
+                     get_gem_home(),
+                     osp.basename(build_root_dir),
+                     utillib.get_framework_version()])
+
+    return utillib.string_digest('\n'.join(key_data))
+
+def _save_build(build_cache, cache_key, build_dir, output_root_dir, gem_home, paths,
+                locked_gems):
+    '''saves the build directory, build.conf, the build archive and the
+    files the build added to the gem directory in the build cache, with
+    the list of the gems in Gemfile.lock that a later hit checks for'''
+
+    def populate(dirpath):
+        # copied, the entry must not share the files of a build directory
+        utillib.copy_tree(build_dir, osp.join(dirpath, 'build'))
+        os.makedirs(osp.join(dirpath, 'output'))
+        for name in ['build.tar.gz', 'build.tar.gz.sha256']:
+            (src, dest) = (osp.join(output_root_dir, name), osp.join(dirpath, 'output', name))
+            if osp.isfile(src):
+                try:
+                    os.link(src, dest)
+                except OSError:
+                    shutil.copy2(src, dest)
+        shutil.copyfile(osp.join(output_root_dir, 'build.conf'), osp.join(dirpath, 'build.conf'))
+        GemHomeSnapshot.save_files(gem_home, paths, osp.join(dirpath, 'gem-home'))
+        with open(osp.join(dirpath, 'gems'), 'w') as fobj:
+            fobj.writelines(gem + '\n' for gem in locked_gems)
+
+    try:
+        build_cache.put(cache_key, populate)
+        build_cache.gc()
+        logging.info('BUILD CACHE: saved %s and %d files of %s',
+                     build_dir, len(paths), gem_home)
+    except OSError as err:
+        logging.warning('BUILD CACHE: %s', err)
+
+def _restore_build(entry_dir, output_root_dir, build_root_dir):
+    '''restores the gems of the build in the build cache entry_dir and
+    copies the build directory, returns (exit_code, build_summary_file).
+    The entry holds only the gems the build added, returns None if the
+    gems in Gemfile.lock or the dependencies of the build that were
+    already installed then are no longer installed'''
+
+    build_conf = confreader.read_conf_into_dict(osp.join(entry_dir, 'build.conf'))
+    build_summary_file = osp.join(build_root_dir, build_conf['build-summary-file'])
+
+    if osp.isdir(osp.join(entry_dir, 'gem-home')):
+        GemHomeSnapshot.restore(osp.join(entry_dir, 'gem-home'), get_gem_home())
+
+    gems_file = osp.join(entry_dir, 'gems')
+    if not osp.isfile(gems_file):
+        logging.warning('BUILD CACHE: %s has no list of gems', entry_dir)
+        return None
+
+    with open(gems_file) as fobj:
+        missing = get_missing_gems(line.strip() for line in fobj if line.strip())
+
+    entry_summary_file = osp.join(entry_dir, 'build', build_conf['build-summary-file'])
+    missing.extend(path for path in BuildSummary.get_external_dependencies(entry_summary_file)
+                   if not osp.exists(path))
+
+    if missing:
+        logging.warning('BUILD CACHE: not installed: %s', ' '.join(missing))
+        return None
+
+    with LogTaskStatus('build') as status_dot_out:
+        os.makedirs(build_root_dir, exist_ok=True)
+        # copied, the assessment must not change the cache entry
+        utillib.copy_tree(osp.join(entry_dir, 'build'), build_root_dir)
+
+        BuildSummary.relocate(build_summary_file, build_root_dir)
+
+        status_dot_out.skip_task('cached')
+
+    with LogTaskStatus('build-archive') as status_dot_out:
+        utillib.link_tree(osp.join(entry_dir, 'output'), output_root_dir)
+        shutil.copyfile(osp.join(entry_dir, 'build.conf'),
+                        osp.join(output_root_dir, 'build.conf'))
+        status_dot_out.skip_task('cached')
+
+    logging.info('BUILD CACHE: restored %s', entry_dir)
+
+    return (int(build_conf['exit-code']), build_summary_file)
+
+def build(input_root_dir, output_root_dir, build_root_dir, background=False):
+    '''builds the package, returns (exit_code, build_summary_file). With
+    background, build.tar.gz and build.conf are written by a thread from a
+    snapshot of the build directory, wait_build_archive() waits for it.
+    With build-cache in run.conf, a build that succeeded is saved in the
+    build cache, and restored from it by the next build of the same
+    package. The gem installs of builds that run at the same time on this
+    host, such as the builds of a batch, run one after the other as they
+    share the gem directories'''
+
+    run_conf = utillib.get_run_conf(input_root_dir)
+    build_cache = cache.get_cache('build', run_conf)
+    cache_key = _get_build_cache_key(input_root_dir, build_root_dir, run_conf) \
+                if build_cache else None
+
+    if cache_key:
+        # not removed by the gc of another process while it is restored
+        with lock_gem_dirs(), build_cache.lock(cache_key):
+            entry_dir = build_cache.get(cache_key)
+            restored = _restore_build(entry_dir, output_root_dir, build_root_dir) \
+                       if entry_dir else None
+            if entry_dir and not restored:
+                build_cache.remove(cache_key)
+
+        if restored:
+            return restored
+
+    gem_home_changes = set() if cache_key else None
+
+    # the build.conf of an exception that is not caught has exit code 1
+    exit_code = 1
+    build_summary_file = None
+    pkg_obj = None
 
     try:
         if not osp.isdir(build_root_dir):
@@ -827,8 +1468,10 @@ def build(input_root_dir, output_root_dir, build_root_dir):
 
         pkg_conf_file = osp.join(input_root_dir, 'package.conf')
         pkg_obj = get_pkg_obj(pkg_conf_file, input_root_dir, build_root_dir)
+        pkg_obj.gem_home_changes = gem_home_changes
         exit_code, build_summary_file = pkg_obj.build(build_root_dir)
     except (UnpackArchiveError,
+            GemFileError,
             NotADirectoryException,
             EmptyPackageError,
             CommandFailedError,
@@ -851,17 +1494,28 @@ def build(input_root_dir, output_root_dir, build_root_dir):
         if build_summary_file:
             build_conf['build-summary-file'] = osp.basename(build_summary_file)
 
-        with LogTaskStatus('build-archive'):
-            build_archive = shutil.make_archive(osp.join(output_root_dir, 'build'),
-                                                'gztar',
-                                                osp.dirname(build_root_dir),
-                                                osp.basename(build_root_dir))
-
-            build_conf['build-archive'] = osp.basename(build_archive)
-            build_conf['build-dir'] = osp.basename(build_root_dir)
-            build_conf.update(pkg_obj.get_build_conf_extras())
-
-            utillib.write_to_file(osp.join(output_root_dir, 'build.conf'), build_conf)
+        build_archive = BuildArchive(input_root_dir, output_root_dir, build_root_dir,
+                                     build_conf,
+                                     pkg_obj.get_build_conf_extras() if pkg_obj else dict())
+
+        if gem_home_changes is not None and exit_code == 0:
+            gem_home = get_gem_home()
+            paths = sorted(gem_home_changes)
+            locked_gems = get_locked_gems(osp.join(getattr(pkg_obj, 'pkg_dir', build_root_dir),
+                                                   'Gemfile.lock')) or []
+            build_archive.on_written = lambda build_dir: _save_build(build_cache, cache_key,
+                                                                     build_dir, output_root_dir,
+                                                                     gem_home, paths,
+                                                                     locked_gems)
+
+        if background:
+            build_archive.start()
+        else:
+            build_archive.write()
 
     return (exit_code, build_summary_file)
 
+def wait_build_archive():
+    '''waits for the build archives started by build(..., background=True),
+    raises the exception of an archive that failed'''
+    BuildArchive.join_all()
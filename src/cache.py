@@ -0,0 +1,231 @@
+import os
+import os.path as osp
+import glob
+import time
+import fcntl
+import shutil
+import logging
+import contextlib
+
+from . import utillib
+from . import confreader
+
+
+class DiskCache:
+    '''Content addressed store of directory trees in the cache directory.
+    Each entry is a directory named by its key, with a <key>.meta file
+    holding its size; the mtime of the meta file is the last time the
+    entry was used. Once the store is larger than max-size, least recently
+    used entries are removed, except entries locked by another process
+    with lock(); the <key>.lock files of removed entries are removed too.'''
+
+    CACHE_CONF = 'cache.conf'
+    DEFAULT_MAX_SIZE = 1024 ** 3
+
+    @classmethod
+    def get_cache_names(cls):
+        cache_root = utillib.get_cache_dir()
+        return sorted(name for name in os.listdir(cache_root)
+                      if osp.isfile(osp.join(cache_root, name, DiskCache.CACHE_CONF)))
+
+    def __init__(self, name, max_size=None):
+        self.name = name
+        self.cache_dir = utillib.get_cache_dir(name)
+        self._tmp_dir = utillib.get_cache_dir(name, 'tmp')
+
+        conf_file = osp.join(self.cache_dir, DiskCache.CACHE_CONF)
+        if osp.isfile(conf_file):
+            cache_conf = confreader.read_conf_into_dict(conf_file)
+        else:
+            cache_conf = dict()
+
+        if max_size is not None:
+            self.max_size = max_size
+        else:
+            self.max_size = int(cache_conf.get('max-size', DiskCache.DEFAULT_MAX_SIZE))
+
+        if cache_conf.get('max-size') != str(self.max_size):
+            utillib.write_to_file(conf_file, {'max-size': str(self.max_size)})
+
+    def _get_entry_dir(self, key):
+        return osp.join(self.cache_dir, key[:2], key)
+
+    @contextlib.contextmanager
+    def lock(self, key, blocking=True):
+        '''holds an exclusive lock on the entry for key, to fill it or to
+        read it while no other process removes it. Yields False if the
+        lock is held by another process and blocking is False'''
+
+        lock_file = self._get_entry_dir(key) + '.lock'
+        os.makedirs(osp.dirname(lock_file), exist_ok=True)
+
+        with open(lock_file, 'a') as lock_fobj:
+            try:
+                fcntl.flock(lock_fobj, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_fobj, fcntl.LOCK_UN)
+
+    def get(self, key):
+        '''returns the entry directory for key, None if not in the cache'''
+
+        entry_dir = self._get_entry_dir(key)
+        meta_file = entry_dir + '.meta'
+
+        if osp.isfile(meta_file) and osp.isdir(entry_dir):
+            try:
+                os.utime(meta_file)
+                return entry_dir
+            except OSError:
+                pass
+
+        return None
+
+    def put(self, key, populate):
+        '''calls populate(dirpath) to fill a new entry for key and adds it
+        to the cache, returns the entry directory, raises OSError if it
+        cannot be added. Call gc once done adding entries to keep the cache
+        within its size limit'''
+
+        tmp_dir = osp.join(self._tmp_dir, '{0}-{1}'.format(key, utillib.get_uuid()))
+        os.makedirs(tmp_dir)
+
+        try:
+            populate(tmp_dir)
+            size = utillib.get_tree_size(tmp_dir)
+
+            entry_dir = self._get_entry_dir(key)
+            os.makedirs(osp.dirname(entry_dir), exist_ok=True)
+
+            try:
+                os.rename(tmp_dir, entry_dir)
+            except OSError:
+                if self.get(key):
+                    # added by someone else in the mean time
+                    return entry_dir
+
+                # left without its .meta file by an interrupted put
+                logging.warning('CACHE %s: replacing %s', self.name, entry_dir)
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                os.rename(tmp_dir, entry_dir)
+
+            utillib.write_to_file(entry_dir + '.meta', {'size': str(size)})
+        finally:
+            if osp.isdir(tmp_dir):
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        return entry_dir
+
+    def _get_entries(self):
+        '''returns a list of (last-used-time, size, key)'''
+
+        entries = list()
+
+        for subdir in os.listdir(self.cache_dir):
+            if len(subdir) != 2 or not osp.isdir(osp.join(self.cache_dir, subdir)):
+                continue
+
+            for meta_name in os.listdir(osp.join(self.cache_dir, subdir)):
+                if not meta_name.endswith('.meta'):
+                    continue
+
+                meta_file = osp.join(self.cache_dir, subdir, meta_name)
+                try:
+                    atime = os.stat(meta_file).st_mtime
+                    size = int(confreader.read_conf_into_dict(meta_file).get('size', 0))
+                except (OSError, ValueError):
+                    continue
+
+                entries.append((atime, size, meta_name[:-len('.meta')]))
+
+        return entries
+
+    def remove(self, key):
+        entry_dir = self._get_entry_dir(key)
+        utillib.rmfile(entry_dir + '.meta')
+        shutil.rmtree(entry_dir, ignore_errors=True)
+
+    def gc(self, max_size=None):
+        '''removes least recently used entries till the cache is smaller than
+        max_size, returns (number of entries removed, bytes freed)'''
+
+        if max_size is None:
+            max_size = self.max_size
+
+        entries = sorted(self._get_entries())
+        total_size = sum(size for (_, size, _) in entries)
+
+        removed = 0
+        freed = 0
+
+        for (_, size, key) in entries:
+            if total_size - freed <= max_size:
+                break
+
+            with self.lock(key, blocking=False) as locked:
+                if not locked:
+                    continue
+
+                self.remove(key)
+                utillib.rmfile(self._get_entry_dir(key) + '.lock')
+                removed += 1
+                freed += size
+
+        if removed:
+            logging.info('CACHE %s: removed %d entries, %d bytes', self.name, removed, freed)
+
+        # lock files of entries removed by remove() or never added
+        for lock_file in glob.glob(osp.join(self.cache_dir, '??', '*.lock')):
+            key = osp.basename(lock_file)[:-len('.lock')]
+            if osp.isfile(self._get_entry_dir(key) + '.meta'):
+                continue
+
+            with self.lock(key, blocking=False) as locked:
+                if locked:
+                    utillib.rmfile(lock_file)
+
+        # stale temporary entries of interrupted runs
+        for tmp_name in os.listdir(self._tmp_dir):
+            tmp_path = osp.join(self._tmp_dir, tmp_name)
+            try:
+                if time.time() - os.stat(tmp_path).st_mtime > 24 * 60 * 60:
+                    shutil.rmtree(tmp_path, ignore_errors=True)
+            except OSError:
+                pass
+
+        return (removed, freed)
+
+
+def get_cache(name, run_conf):
+    '''Returns the DiskCache name if <name>-cache is true in run.conf,
+    otherwise None. The size limit is <name>-cache-max-size or
+    cache-max-size from run.conf'''
+
+    if not utillib.string_to_bool(run_conf.get(name + '-cache', 'false')):
+        return None
+
+    max_size = run_conf.get(name + '-cache-max-size', run_conf.get('cache-max-size'))
+
+    if max_size:
+        return DiskCache(name, utillib.string_to_size(max_size))
+    else:
+        return DiskCache(name)
+
+
+def main(args):
+    '''the cache maintenance command'''
+
+    if args.cache_cmd == 'gc':
+        names = args.names if args.names else DiskCache.get_cache_names()
+
+        for name in names:
+            disk_cache = DiskCache(name)
+            (removed, freed) = disk_cache.gc(args.max_size)
+            print('{0}: removed {1} entries, freed {2} bytes'.format(name, removed, freed))
+
+    return 0
@@ -3,6 +3,8 @@ import subprocess
 import os
 import pkgutil
 
+from . import utillib
+
 class PrintPlatform(argparse.Action):
     def __call__(self, parser, namespace, values, option_string=None):
         namespace.platform = os.getenv('VMPLATNAME')
@@ -39,6 +41,14 @@ def process_cmd_line_args():
                         action=PrintPlatform,
                         help='gets the current platform name and version')
 
+    parser.add_argument('--jobs',
+                        dest='jobs',
+                        type=int,
+                        required=False,
+                        default=None,
+                        help='number of tool invocations to run in parallel, '
+                        'default is the jobs parameter in run.conf or the number of CPUs')
+
     parser.add_argument('input_dir',
                         type=str,
                         help='Path to the Input Directory')
@@ -61,3 +71,68 @@ def process_cmd_line_args():
 
     return parser.parse_args()
 
+def process_cache_cmd_line_args(args):
+    parser = argparse.ArgumentParser(prog='ruby-assess cache',
+                                     description='''Maintain the ruby-assess cache directory''')
+
+    parser.add_argument('--cache-dir',
+                        dest='cache_dir',
+                        type=str,
+                        required=False,
+                        help='cache directory, default RUBY_ASSESS_CACHE_DIR '
+                        'or ~/.cache/ruby-assess')
+
+    subparsers = parser.add_subparsers(dest='cache_cmd')
+    subparsers.required = True
+
+    gc_parser = subparsers.add_parser('gc',
+                                      help='remove least recently used entries '
+                                      'till each cache is within its size limit')
+
+    gc_parser.add_argument('--max-size',
+                           dest='max_size',
+                           type=utillib.string_to_size,
+                           required=False,
+                           default=None,
+                           help='size limit for each cache, such as 500M or 2G, '
+                           'default is the cache-max-size of the runs that filled it')
+
+    gc_parser.add_argument('names',
+                           nargs='*',
+                           help='caches to clean, default all')
+
+    return parser.parse_args(args)
+
+def process_batch_cmd_line_args(args):
+    parser = argparse.ArgumentParser(prog='ruby-assess batch',
+                                     description='''Build, assess and parse many ruby packages,
+                                     the tools and result parsers are set up once for all''')
+
+    parser.add_argument('--jobs',
+                        dest='jobs',
+                        type=int,
+                        required=False,
+                        default=None,
+                        help='number of tool invocations to run in parallel for each package, '
+                        'default is the jobs parameter in run.conf or the number of CPUs')
+
+    parser.add_argument('--workers',
+                        dest='workers',
+                        type=int,
+                        required=False,
+                        default=None,
+                        help='number of packages to run in parallel, default is the number of CPUs')
+
+    parser.add_argument('--work-dir',
+                        dest='work_dir',
+                        type=str,
+                        required=False,
+                        default=os.getcwd(),
+                        help='directory for the tools, the result parsers and the build and '
+                        'results directories of the packages, default is the current directory')
+
+    parser.add_argument('manifest',
+                        type=str,
+                        help='file with one <input-dir> <output-dir> line for each package')
+
+    return parser.parse_args(args)
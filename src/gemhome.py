@@ -0,0 +1,140 @@
+import os
+import fcntl
+import logging
+import contextlib
+import os.path as osp
+
+from . import utillib
+from .rubyenv import RubyEnv
+
+
+def get_gem_home():
+    '''the directory gem install and bundle install install gems in'''
+    return os.getenv('GEM_HOME') or RubyEnv.get()['gem-dir']
+
+
+def get_gem_dirs():
+    '''the directories gems are loaded from, GEM_HOME first'''
+    return utillib.ordered_list(([os.getenv('GEM_HOME')] if os.getenv('GEM_HOME') else []) +
+                                RubyEnv.get().get_gem_path())
+
+
+def get_missing_gems(full_names):
+    '''returns the gems in full_names, <name>-<version>[-<platform>], that
+    are not installed in any of the gem directories'''
+
+    spec_dirs = [osp.join(gem_dir, 'specifications', subdir)
+                 for gem_dir in get_gem_dirs()
+                 for subdir in ['', 'default']]
+
+    return [full_name for full_name in full_names
+            if not any(osp.isfile(osp.join(spec_dir, full_name + '.gemspec'))
+                       for spec_dir in spec_dirs)]
+
+
+def get_installed_gems(gem_dir):
+    '''returns the sorted full names, <name>-<version>[-<platform>], of the
+    gems installed in gem_dir'''
+
+    spec_dir = osp.join(gem_dir, 'specifications')
+    if not osp.isdir(spec_dir):
+        return []
+
+    return sorted(name[:-len('.gemspec')] for name in os.listdir(spec_dir)
+                  if name.endswith('.gemspec'))
+
+
+@contextlib.contextmanager
+def lock_gem_dirs(changes=None):
+    '''holds an exclusive lock, shared by the ruby-assess processes on this
+    host, while gems are installed in GEM_HOME or the gem user directory,
+    so that the gems a build or a tool install adds are its own. With
+    changes, a set, the paths the installs add or change in GEM_HOME are
+    added to it'''
+
+    with open(osp.join(utillib.get_cache_dir(), 'gem-dirs.lock'), 'w') as lock_fobj:
+        fcntl.flock(lock_fobj, fcntl.LOCK_EX)
+        try:
+            snapshot = GemHomeSnapshot(get_gem_home()) if changes is not None else None
+            yield
+            if snapshot:
+                changes.update(snapshot.diff())
+        finally:
+            fcntl.flock(lock_fobj, fcntl.LOCK_UN)
+
+
+class GemHomeSnapshot:
+    '''The files in a gem directory at one point in time, to find the files
+    a command such as bundle install added or changed, and to save these
+    files to and restore them from a cache entry.
+    Files are hard linked if possible, copied otherwise.'''
+
+    def __init__(self, gem_home):
+        self.gem_home = gem_home
+        self._files = self._scan()
+
+    def _scan(self):
+        files = dict()
+
+        if not osp.isdir(self.gem_home):
+            return files
+
+        for (dirpath, dirnames, filenames) in os.walk(self.gem_home):
+            for name in dirnames + filenames:
+                path = osp.join(dirpath, name)
+                try:
+                    stat = os.lstat(path)
+                except OSError:
+                    continue
+
+                if name in dirnames and not osp.islink(path):
+                    files[osp.relpath(path, self.gem_home)] = None
+                else:
+                    files[osp.relpath(path, self.gem_home)] = (stat.st_size, stat.st_mtime_ns)
+
+        return files
+
+    def diff(self):
+        '''returns the sorted relative paths of the files and directories
+        added or changed since the snapshot was taken'''
+
+        current = self._scan()
+        return sorted(path for (path, stat) in current.items()
+                      if path not in self._files or self._files[path] != stat)
+
+    def save(self, paths, dest_dir):
+        '''saves the files in paths, relative to the gem directory, in dest_dir'''
+        GemHomeSnapshot.save_files(self.gem_home, paths, dest_dir)
+
+    @classmethod
+    def save_files(cls, gem_home, paths, dest_dir):
+        '''saves the files in paths, relative to gem_home, in dest_dir'''
+
+        for path in paths:
+            src = osp.join(gem_home, path)
+            dest = osp.join(dest_dir, path)
+
+            if osp.isdir(src) and not osp.islink(src):
+                os.makedirs(dest, exist_ok=True)
+            else:
+                os.makedirs(osp.dirname(dest), exist_ok=True)
+                utillib._link_or_copy(src, dest)
+
+    @classmethod
+    def restore(cls, src_dir, gem_home):
+        '''restores the files saved in src_dir into gem_home, files that are
+        already in gem_home are replaced'''
+
+        count = 0
+
+        for (dirpath, dirnames, filenames) in os.walk(src_dir):
+            dest_dir = osp.join(gem_home, osp.relpath(dirpath, src_dir))
+            os.makedirs(dest_dir, exist_ok=True)
+
+            for name in filenames + [name for name in dirnames
+                                     if osp.islink(osp.join(dirpath, name))]:
+                utillib._link_or_copy(osp.join(dirpath, name), osp.join(dest_dir, name))
+                count += 1
+
+        logging.info('GEM HOME: restored %d files from %s in %s', count, src_dir, gem_home)
+        return count
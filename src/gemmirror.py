@@ -0,0 +1,219 @@
+import os
+import re
+import glob
+import fcntl
+import shutil
+import logging
+import threading
+import subprocess
+import posixpath
+import contextlib
+import socketserver
+import http.server
+import urllib.parse
+import os.path as osp
+
+from . import utillib
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    '''http.server.ThreadingHTTPServer is from Python 3.7'''
+
+    daemon_threads = True
+
+    def __init__(self, server_address, handler_class, mirror_dir):
+        http.server.HTTPServer.__init__(self, server_address, handler_class)
+        self.mirror_dir = mirror_dir
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+
+    def log_message(self, fmt, *args):
+        logging.debug('GEM MIRROR: ' + fmt, *args)
+
+    def translate_path(self, path):
+        '''maps the request path onto the mirror directory of the server,
+        the directory keyword of the handler is from Python 3.7 and the
+        current directory is shared by the threads of the process'''
+
+        path = urllib.parse.unquote(path.split('?', 1)[0].split('#', 1)[0])
+        words = [word for word in posixpath.normpath(path).split('/')
+                 if word and word not in (os.curdir, os.pardir)]
+
+        translated = osp.join(self.server.mirror_dir, *words)
+        if path.rstrip().endswith('/'):
+            translated += '/'
+
+        return translated
+
+
+def get_locked_gems(lock_file):
+    '''returns the <name>-<version>[-<platform>] of the gems from gem
+    servers in Gemfile.lock, None if there is no Gemfile.lock'''
+
+    if not osp.isfile(lock_file):
+        return None
+
+    spec_regex = re.compile(r'^    ([^\s(]+) \(([^)\s]+)\)$')
+    gems = list()
+    section = None
+
+    with open(lock_file) as fobj:
+        for line in fobj:
+            line = line.rstrip('\n')
+            if line and not line.startswith(' '):
+                section = line.strip()
+            elif section == 'GEM':
+                match = spec_regex.match(line)
+                if match:
+                    gems.append('{0}-{1}'.format(match.group(1), match.group(2)))
+
+    return gems
+
+
+class GemMirror:
+    '''A gem server directory in the cache directory holding every .gem
+    file seen by the builds, with the specs.4.8.gz indexes RubyGems and
+    Bundler read. serve() makes it available at an http://127.0.0.1 URL
+    for the duration of a gem or bundle command'''
+
+    SUBDIR = 'gem-mirror'
+    RUBYGEMS_URL = 'https://rubygems.org/'
+
+    INDEX_SCRIPT = '''
+require "rubygems/package"
+require "fileutils"
+require "zlib"
+dir = ARGV[0]
+begin
+  require "rubygems/indexer"
+  Gem::Indexer.new(dir, build_modern: true).generate_index
+  exit 0
+rescue LoadError
+end
+specs = Dir[File.join(dir, "gems", "*.gem")].sort.map do |file|
+  begin
+    Gem::Package.new(file).spec
+  rescue StandardError => err
+    warn "#{file}: #{err}"
+    nil
+  end
+end.compact
+quick_dir = File.join(dir, "quick", "Marshal.#{Gem.marshal_version}")
+FileUtils.mkdir_p(quick_dir)
+specs.each do |spec|
+  File.binwrite(File.join(quick_dir, "#{spec.original_name}.gemspec.rz"),
+                Zlib::Deflate.deflate(Marshal.dump(spec)))
+end
+tuples = specs.map do |spec|
+  platform = spec.original_platform.to_s
+  [spec.name, spec.version, platform.empty? ? "ruby" : platform]
+end.sort_by {|tuple| [tuple[0], tuple[1], tuple[2]] }
+releases, prereleases = tuples.partition {|tuple| !tuple[1].prerelease? }
+latest = releases.group_by {|tuple| [tuple[0], tuple[2]] }.map {|_, list| list.last }
+{ "specs" => releases, "latest_specs" => latest,
+  "prerelease_specs" => prereleases }.each do |name, list|
+  index_file = File.join(dir, "#{name}.#{Gem.marshal_version}.gz")
+  Zlib::GzipWriter.open(index_file + ".tmp") {|gzip| gzip.write(Marshal.dump(list)) }
+  File.rename(index_file + ".tmp", index_file)
+end
+'''
+
+    @classmethod
+    def get(cls, run_conf):
+        '''returns the GemMirror if gem-mirror is true in run.conf, otherwise None'''
+
+        if utillib.string_to_bool(run_conf.get('gem-mirror', 'false')):
+            return GemMirror(utillib.string_to_bool(run_conf.get('internet-inaccessible',
+                                                                 'false')))
+        else:
+            return None
+
+    def __init__(self, offline=False):
+        self.offline = offline
+        self.mirror_dir = utillib.get_cache_dir(GemMirror.SUBDIR)
+        self.gems_dir = utillib.get_cache_dir(GemMirror.SUBDIR, 'gems')
+        self._index_file = osp.join(self.mirror_dir, 'specs.4.8.gz')
+
+    @contextlib.contextmanager
+    def _lock(self):
+        with open(osp.join(self.mirror_dir, '.lock'), 'w') as lock_fobj:
+            fcntl.flock(lock_fobj, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_fobj, fcntl.LOCK_UN)
+
+    def add(self, gem_files):
+        '''adds the .gem files that are not in the mirror yet, returns the
+        number of files added'''
+
+        added = 0
+
+        for gem_file in gem_files:
+            dest = osp.join(self.gems_dir, osp.basename(gem_file))
+            if osp.isfile(dest) or not osp.isfile(gem_file):
+                continue
+
+            tmp_file = '{0}.{1}'.format(dest, utillib.get_uuid())
+            try:
+                os.link(gem_file, tmp_file)
+            except OSError:
+                shutil.copyfile(gem_file, tmp_file)
+            os.replace(tmp_file, dest)
+            added += 1
+
+        if added:
+            logging.info('GEM MIRROR: added %d gems', added)
+
+        return added
+
+    def harvest(self, gem_home):
+        '''adds the .gem files in the cache directory of gem_home'''
+        return self.add(glob.glob(osp.join(gem_home, 'cache', '*.gem')))
+
+    def has_gems(self, full_names):
+        return all(osp.isfile(osp.join(self.gems_dir, full_name + '.gem'))
+                   for full_name in full_names)
+
+    def update_index(self):
+        '''regenerates the indexes if gems were added since they were generated'''
+
+        with self._lock():
+            if osp.isfile(self._index_file) and \
+               os.stat(self._index_file).st_mtime >= os.stat(self.gems_dir).st_mtime:
+                return 0
+
+            exit_code = subprocess.call(['ruby', '-e', GemMirror.INDEX_SCRIPT, self.mirror_dir],
+                                        stdout=subprocess.DEVNULL)
+            logging.info('GEM MIRROR: index %s exit code %d', self.mirror_dir, exit_code)
+            return exit_code
+
+    @contextlib.contextmanager
+    def serve(self):
+        '''serves the mirror directory over http on localhost, yields the URL'''
+
+        server = _Server(('127.0.0.1', 0), _QuietHandler, self.mirror_dir)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+
+        try:
+            yield 'http://127.0.0.1:{0}/'.format(server.server_address[1])
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    def get_gem_source_args(self, url):
+        '''gem install options to install from the mirror at url first,
+        then from rubygems.org unless the internet is inaccessible'''
+
+        args = ['--clear-sources', '--source', url]
+        if not self.offline:
+            args.extend(['--source', GemMirror.RUBYGEMS_URL])
+        return args
+
+    def get_bundle_env(self, url):
+        '''environment variables for bundle install to get the gems from
+        rubygems.org from the mirror at url'''
+        return {'BUNDLE_MIRROR__HTTPS://RUBYGEMS__ORG/': url}
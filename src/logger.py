@@ -199,3 +199,13 @@ def shutdown():
     LogTaskStatus.status_end()
     logging.shutdown()
 
+
+def detach():
+    '''removes the handlers init added, in a process forked to log in
+    another output directory'''
+
+    for name in ['', '.status-logger']:
+        log = logging.getLogger(name)
+        for handler in list(log.handlers):
+            log.removeHandler(handler)
+            handler.close()
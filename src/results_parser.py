@@ -1,16 +1,16 @@
 import os
 import os.path as osp
 import logging
-import shutil
 import re
 
 from .logger import LogTaskStatus
 from . import utillib
 from . import confreader
+from . import cache
 from .utillib import FileNotFoundException
 
 
-def just_parse(input_root_dir, output_root_dir):
+def just_parse(input_root_dir, output_root_dir, parser_exe_file=None):
 
     results_conf_file = osp.join(input_root_dir, 'results.conf')
     results_conf = confreader.read_conf_into_dict(results_conf_file)
@@ -33,10 +33,12 @@ def just_parse(input_root_dir, output_root_dir):
     return parse_results(input_root_dir,
                          assessment_summary_file,
                          results_root_dir,
-                         output_root_dir)
+                         output_root_dir,
+                         parser_exe_file=parser_exe_file)
 
 
-def _get_results_parser(input_dir):
+def get_results_parser(input_dir):
+    '''unarchives the result parser, returns the path of its executable'''
 
     with LogTaskStatus('resultparser-unarchive'):
 
@@ -54,7 +56,9 @@ def _get_results_parser(input_dir):
 
         parser_archive = osp.join(input_dir, parser_attr['result-parser-archive'])
 
-        utillib.unpack_archive(parser_archive, parser_dir)
+        utillib.unpack_archive(parser_archive, parser_dir,
+                               unpack_cache=cache.get_cache('unpack',
+                                                            utillib.get_run_conf(input_dir)))
 
         parser_dir = osp.join(parser_dir, parser_attr['result-parser-dir'])
         parser_exe_file = osp.join(parser_dir, parser_attr['result-parser-cmd'])
@@ -94,7 +98,8 @@ def read_task_info_file(weakness_count_file):
     return (short_msg, status, long_msg)
 
 
-def parse_results(input_dir, assessment_summary_file, results_dir, output_dir):
+def parse_results(input_dir, assessment_summary_file, results_dir, output_dir,
+                  parser_exe_file=None):
 
     command_template = '{EXECUTABLE}\
  --summary_file={PATH_TO_SUMMARY_FILE}\
@@ -106,7 +111,8 @@ def parse_results(input_dir, assessment_summary_file, results_dir, output_dir):
     if not osp.isfile(assessment_summary_file):
         raise FileNotFoundException(assessment_summary_file)
 
-    parser_exe_file = _get_results_parser(input_dir)
+    if parser_exe_file is None:
+        parser_exe_file = get_results_parser(input_dir)
 
     services_conf_file = osp.join(input_dir, 'services.conf')
     if osp.isfile(services_conf_file):
@@ -180,11 +186,12 @@ def parse_results(input_dir, assessment_summary_file, results_dir, output_dir):
         exit_code = 1
     finally:
         with LogTaskStatus('parsed-results-archive'):
-            shutil.make_archive(osp.join(output_dir,
-                                         osp.basename(parse_results_dir)),
-                                'gztar',
-                                osp.dirname(parse_results_dir),
-                                osp.basename(parse_results_dir))
+            run_conf = utillib.get_run_conf(input_dir)
+            utillib.make_archive(osp.join(output_dir,
+                                          osp.basename(parse_results_dir)),
+                                 osp.dirname(parse_results_dir),
+                                 osp.basename(parse_results_dir),
+                                 utillib.get_archive_level(run_conf))
 
         fileFound = osp.isfile(parsed_results_data_conf_file)
         if fileFound:
@@ -0,0 +1,104 @@
+import os
+import os.path as osp
+import shutil
+import hashlib
+import logging
+import threading
+import subprocess
+
+from . import utillib
+from . import confreader
+
+
+class RubyEnv:
+    '''Settings of the ruby in PATH, probed once per run and saved
+    in the cache directory, keyed by the identity of the ruby executable
+    and the environment variables that change what it reports'''
+
+    CACHE_SUBDIR = 'ruby-env'
+
+    PROBE_SCRIPT = '; '.join([
+        'puts "gem-user-dir=#{Gem.user_dir}"',
+        'puts "gem-dir=#{Gem.dir}"',
+        'puts "gem-path=#{Gem.path.join(File::PATH_SEPARATOR)}"',
+        'puts "gem-bindir=#{Gem.bindir}"',
+        'puts "gem-version=#{Gem::VERSION}"',
+        'puts "ruby-version=#{RUBY_VERSION}"',
+        'puts "ruby-platform=#{RUBY_PLATFORM}"',
+    ])
+
+    IDENTITY_ENV = ['PATH', 'HOME', 'GEM_HOME', 'GEM_PATH',
+                    'RUBY_VERSION', 'MY_RUBY_HOME', 'RBENV_VERSION']
+
+    _lock = threading.Lock()
+    _ruby_env = None
+
+    @classmethod
+    def _get_identity(cls, ruby_exe):
+        stat = os.stat(ruby_exe)
+        identity = [osp.realpath(ruby_exe), str(stat.st_ino),
+                    str(stat.st_size), str(stat.st_mtime)]
+        identity.extend('{0}={1}'.format(key, os.environ.get(key, ''))
+                        for key in RubyEnv.IDENTITY_ENV)
+        return hashlib.sha1('\n'.join(identity).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def _probe(cls, ruby_exe, conf_file):
+        tmp_file = '{0}.{1}'.format(conf_file, os.getpid())
+
+        with open(tmp_file, 'w') as fobj:
+            exit_code = subprocess.call([ruby_exe, '-r', 'rubygems',
+                                         '-e', RubyEnv.PROBE_SCRIPT],
+                                        stdout=fobj)
+
+        attrs = confreader.read_conf_into_dict(tmp_file)
+
+        if exit_code == 0:
+            os.replace(tmp_file, conf_file)
+        else:
+            logging.warning('RUBY ENV: probe %s exit code %d', ruby_exe, exit_code)
+            utillib.rmfile(tmp_file)
+
+        return attrs
+
+    @classmethod
+    def get(cls):
+        '''returns the RubyEnv of this run, probing ruby on first use'''
+
+        with RubyEnv._lock:
+            if RubyEnv._ruby_env is None:
+                RubyEnv._ruby_env = RubyEnv._load()
+
+            return RubyEnv._ruby_env
+
+    @classmethod
+    def _load(cls):
+        ruby_exe = shutil.which('ruby')
+
+        if ruby_exe is None:
+            logging.warning('RUBY ENV: ruby not found in PATH')
+            return RubyEnv(dict())
+
+        cache_dir = utillib.get_cache_dir(RubyEnv.CACHE_SUBDIR)
+        conf_file = osp.join(cache_dir, RubyEnv._get_identity(ruby_exe) + '.conf')
+
+        if osp.isfile(conf_file):
+            attrs = confreader.read_conf_into_dict(conf_file)
+            logging.info('RUBY ENV (CACHED %s): %s', conf_file, attrs)
+        else:
+            attrs = RubyEnv._probe(ruby_exe, conf_file)
+            logging.info('RUBY ENV: %s', attrs)
+
+        return RubyEnv(attrs)
+
+    def __init__(self, attrs):
+        self._attrs = attrs
+
+    def __contains__(self, key):
+        return key in self._attrs
+
+    def __getitem__(self, key):
+        return self._attrs.get(key, '')
+
+    def get_gem_path(self):
+        return [path for path in self['gem-path'].split(os.pathsep) if path]
@@ -0,0 +1,359 @@
+import os
+import re
+import gzip
+import base64
+import logging
+import tarfile
+import functools
+import threading
+import os.path as osp
+
+import yaml
+
+
+class GemFileError(Exception):
+
+    def __init__(self, gem_file, reason, build_summary_file=None):
+        Exception.__init__(self)
+        self.gem_file = gem_file
+        self.reason = reason
+        self.build_summary_file = build_summary_file
+        self.exit_code = 5
+
+    def __str__(self):
+        return "Reading gem '{0}' failed: {1}".format(osp.basename(self.gem_file),
+                                                     self.reason)
+
+
+class GemSpecLoader(yaml.SafeLoader):
+    '''Loads the YAML of a Gem::Specification, objects tagged
+    !ruby/object:Gem::... are loaded as plain dicts, lists and strings'''
+
+    def construct_ruby_object(self, tag_suffix, node):
+        if isinstance(node, yaml.MappingNode):
+            return self.construct_mapping(node, deep=True)
+        elif isinstance(node, yaml.SequenceNode):
+            return self.construct_sequence(node, deep=True)
+        else:
+            return self.construct_scalar(node)
+
+    def construct_binary(self, node):
+        return base64.b64decode(self.construct_scalar(node)).decode('utf-8', 'replace')
+
+
+GemSpecLoader.add_multi_constructor('!ruby/', GemSpecLoader.construct_ruby_object)
+GemSpecLoader.add_constructor('!binary', GemSpecLoader.construct_binary)
+
+
+class GemFile:
+    '''A .gem file, a tar file with the gzip'ed YAML specification in
+    metadata.gz and the files of the gem in data.tar.gz'''
+
+    METADATA = 'metadata.gz'
+    DATA = 'data.tar.gz'
+
+    def __init__(self, gem_file):
+        self.gem_file = gem_file
+
+    def _open_member(self, tar, name):
+        try:
+            return tar.extractfile(tar.getmember(name))
+        except KeyError:
+            raise GemFileError(self.gem_file, "'{0}' not found".format(name))
+
+    def read_spec(self):
+        '''returns the specification of the gem as a dict'''
+
+        try:
+            with tarfile.open(self.gem_file, 'r:') as tar:
+                with gzip.open(self._open_member(tar, GemFile.METADATA)) as fobj:
+                    gem_spec = yaml.load(fobj, Loader=GemSpecLoader)
+        except (tarfile.TarError, OSError, EOFError, yaml.YAMLError) as err:
+            raise GemFileError(self.gem_file, str(err))
+
+        if not isinstance(gem_spec, dict):
+            raise GemFileError(self.gem_file, 'invalid specification')
+
+        logging.info('GEM SPEC: %s', gem_spec)
+        return gem_spec
+
+    def extract(self, dirpath):
+        '''extracts the files of the gem in dirpath'''
+
+        extract_args = dict()
+        if hasattr(tarfile, 'data_filter'):
+            extract_args['filter'] = 'data'
+
+        try:
+            with tarfile.open(self.gem_file, 'r:') as tar:
+                with tarfile.open(fileobj=self._open_member(tar, GemFile.DATA),
+                                  mode='r|gz') as data_tar:
+                    data_tar.extractall(dirpath, **extract_args)
+        except (tarfile.TarError, OSError, EOFError) as err:
+            raise GemFileError(self.gem_file, str(err))
+
+
+@functools.total_ordering
+class GemVersion:
+    '''A gem version, compared like Gem::Version. Versions are split into
+    numeric and alphabetic segments, a version with an alphabetic segment
+    is a prerelease and comes before the release'''
+
+    def __init__(self, version):
+        self.version = str(version).strip()
+        self.segments = [int(seg) if seg.isdigit() else seg
+                         for seg in re.findall(r'[0-9]+|[a-z]+', self.version, re.IGNORECASE)]
+
+    def is_prerelease(self):
+        return any(isinstance(seg, str) for seg in self.segments)
+
+    def _release_segments(self):
+        segments = list()
+        for seg in self.segments:
+            if isinstance(seg, str):
+                break
+            segments.append(seg)
+        return segments
+
+    def release(self):
+        '''the version without the prerelease segments, 1.2.pre -> 1.2'''
+        return GemVersion('.'.join(str(seg) for seg in self._release_segments()))
+
+    def bump(self):
+        '''the version for the upper bound of ~>, 1.2.3 -> 1.3'''
+        segments = self._release_segments()
+        if len(segments) > 1:
+            segments.pop()
+        segments[-1] += 1
+        return GemVersion('.'.join(str(seg) for seg in segments))
+
+    def canonical(self):
+        '''the segments without trailing zeros of the release and of the
+        prerelease part, 1.0.pre.0 -> 1.pre'''
+
+        release = self._release_segments()
+        prerelease = self.segments[len(release):]
+
+        for part in [release, prerelease]:
+            while part and part[-1] == 0:
+                part.pop()
+
+        return release + prerelease
+
+    def _cmp(self, other):
+        lhs = self.canonical()
+        rhs = other.canonical()
+        size = max(len(lhs), len(rhs))
+        lhs += [0] * (size - len(lhs))
+        rhs += [0] * (size - len(rhs))
+
+        for (left, right) in zip(lhs, rhs):
+            if left == right:
+                continue
+            if isinstance(left, str) and isinstance(right, int):
+                return -1
+            if isinstance(left, int) and isinstance(right, str):
+                return 1
+            return -1 if left < right else 1
+
+        return 0
+
+    def __eq__(self, other):
+        return self._cmp(other) == 0
+
+    def __lt__(self, other):
+        return self._cmp(other) < 0
+
+    def __hash__(self):
+        return hash(tuple(self.canonical()))
+
+    def __str__(self):
+        return self.version
+
+
+class GemRequirement:
+    '''A list of version constraints such as ["~> 1.2", ">= 1.2.3"]'''
+
+    OPERATORS = {
+        '=': lambda version, req: version == req,
+        '!=': lambda version, req: version != req,
+        '>': lambda version, req: version > req,
+        '<': lambda version, req: version < req,
+        '>=': lambda version, req: version >= req,
+        '<=': lambda version, req: version <= req,
+        '~>': lambda version, req: req <= version and version.release() < req.bump(),
+    }
+
+    REGEX = re.compile(r'^\s*(=|!=|>=|<=|>|<|~>)?\s*(\S+)\s*$')
+
+    def __init__(self, constraints):
+        self.constraints = list()
+
+        for constraint in constraints:
+            match = GemRequirement.REGEX.match(constraint)
+            if match:
+                self.constraints.append((match.group(1) or '=', GemVersion(match.group(2))))
+            else:
+                logging.warning('Invalid gem requirement: %s', constraint)
+
+    def is_prerelease(self):
+        return any(version.is_prerelease() for (_, version) in self.constraints)
+
+    def is_satisfied_by(self, version):
+        return all(GemRequirement.OPERATORS[op](version, req)
+                   for (op, req) in self.constraints)
+
+
+class InstalledGem:
+    '''A gem installed in a gem directory, read from its specification in
+    <gem-dir>/specifications/<name>-<version>[-<platform>].gemspec'''
+
+    STUB_REGEX = re.compile(r'^# stub: (\S+) (\S+) (\S+) (.*)$')
+    DEPENDENCY_REGEX = re.compile(r'\.add_(?:runtime_)?dependency\(%q<([^>]+)>(?:\.freeze)?'
+                                  r'(?:,\s*\[([^\]]*)\])?')
+    ATTR_REGEX = '^\\s*s\\.{0}\\s*=\\s*"([^"]*)"'
+
+    def __init__(self, gem_dir, spec_file):
+        self.gem_dir = gem_dir
+        self.spec_file = spec_file
+        self.full_name = osp.basename(spec_file)[:-len('.gemspec')]
+        self._dependencies = None
+
+        with open(spec_file, encoding='utf-8', errors='replace') as fobj:
+            header = ''.join(fobj.readline() for _ in range(3))
+
+        stub = None
+        for line in header.splitlines():
+            stub = InstalledGem.STUB_REGEX.match(line)
+            if stub:
+                break
+
+        if stub:
+            self.name = stub.group(1)
+            self.version = GemVersion(stub.group(2))
+            self.platform = stub.group(3)
+            self.require_paths = stub.group(4).split('\0')
+        else:
+            spec = self._read_spec()
+            self.name = InstalledGem._get_attr(spec, 'name') or self.full_name
+            self.version = GemVersion(InstalledGem._get_attr(spec, 'version') or '0')
+            self.platform = InstalledGem._get_attr(spec, 'platform') or 'ruby'
+            self.require_paths = ['lib']
+
+    @classmethod
+    def _get_attr(cls, spec, attr):
+        match = re.search(InstalledGem.ATTR_REGEX.format(attr), spec, re.MULTILINE)
+        return match.group(1) if match else None
+
+    def _read_spec(self):
+        with open(self.spec_file, encoding='utf-8', errors='replace') as fobj:
+            return fobj.read()
+
+    def get_dependencies(self):
+        '''returns a list of (name, GemRequirement) of the runtime dependencies'''
+
+        if self._dependencies is None:
+            self._dependencies = list()
+            names = set()
+
+            for match in InstalledGem.DEPENDENCY_REGEX.finditer(self._read_spec()):
+                if match.group(1) not in names:
+                    names.add(match.group(1))
+                    constraints = re.findall(r'"([^"]*)"', match.group(2) or '')
+                    self._dependencies.append((match.group(1),
+                                               GemRequirement(constraints)))
+
+        return self._dependencies
+
+    def get_lib_dirs(self):
+        gem_path = osp.join(self.gem_dir, 'gems', self.full_name)
+        return [osp.join(gem_path, path) for path in self.require_paths]
+
+
+class GemIndex:
+    '''Index by name of the gems installed in a list of gem directories,
+    with default_gems also of the default gems that come with ruby.
+    Indexes are built once per run for a list of gem directories'''
+
+    _lock = threading.Lock()
+    _indexes = dict()
+
+    @classmethod
+    def get(cls, gem_dirs, default_gems=False):
+        key = (tuple(gem_dirs), default_gems)
+
+        with GemIndex._lock:
+            if key not in GemIndex._indexes:
+                GemIndex._indexes[key] = GemIndex(gem_dirs, default_gems)
+
+            return GemIndex._indexes[key]
+
+    def __init__(self, gem_dirs, default_gems=False):
+        self._gems = dict()
+
+        spec_subdirs = ['specifications']
+        if default_gems:
+            spec_subdirs.append(osp.join('specifications', 'default'))
+
+        for (gem_dir, spec_dir) in [(gem_dir, osp.join(gem_dir, subdir))
+                                    for gem_dir in gem_dirs for subdir in spec_subdirs]:
+            if not osp.isdir(spec_dir):
+                continue
+
+            for spec_name in os.listdir(spec_dir):
+                if spec_name.endswith('.gemspec'):
+                    try:
+                        gem = InstalledGem(gem_dir, osp.join(spec_dir, spec_name))
+                    except OSError as err:
+                        logging.warning('GEM INDEX: %s', err)
+                        continue
+
+                    self._gems.setdefault(gem.name, list()).append(gem)
+
+        for gems in self._gems.values():
+            # highest version first, platform specific gems before ruby gems
+            gems.sort(key=lambda gem: gem.platform == 'ruby')
+            gems.sort(key=lambda gem: gem.version, reverse=True)
+
+    def find(self, name, requirement=None):
+        '''returns the installed gem with the highest version that satisfies
+        requirement, prereleases only if the requirement is a prerelease'''
+
+        gems = self._gems.get(name, [])
+        if requirement is None:
+            requirement = GemRequirement([])
+
+        matches = [gem for gem in gems if requirement.is_satisfied_by(gem.version)]
+        releases = [gem for gem in matches if not gem.version.is_prerelease()]
+
+        if releases and not requirement.is_prerelease():
+            return releases[0]
+        elif matches:
+            return matches[0]
+        else:
+            return None
+
+    def resolve(self, dependencies):
+        '''returns the installed gems for dependencies, a list of
+        (name, GemRequirement), and their runtime dependencies'''
+
+        resolved = dict()
+        pending = list(dependencies)
+
+        while pending:
+            (name, requirement) = pending.pop(0)
+
+            if name in resolved:
+                continue
+
+            gem = self.find(name, requirement)
+
+            if gem is None:
+                logging.warning('GEM INDEX: no installed gem %s %s', name,
+                                [op + ' ' + str(ver) for (op, ver) in requirement.constraints])
+                continue
+
+            resolved[name] = gem
+            pending.extend(gem.get_dependencies())
+
+        return [resolved[name] for name in sorted(resolved)]
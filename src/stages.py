@@ -0,0 +1,113 @@
+import logging
+import concurrent.futures
+
+
+class Stage:
+
+    def __init__(self, name, func, depends, when):
+        self.name = name
+        self.func = func
+        self.depends = list(depends)
+        self.when = when
+
+
+class StageGraph:
+    '''Stages of a run and the stages each depends on. A stage is started
+    in its own thread as soon as the stages it depends on are done, so
+    stages that do not depend on each other run at the same time.
+
+    func(results) is called with the dict of the return values of the
+    stages done so far. A stage with when(results) false is skipped, and
+    so are the stages that depend on it. If a stage raises an exception,
+    the stages that depend on it are not run, and run() raises it once
+    the other stages are done, unless no stage that depends on it was
+    going to run anyway.'''
+
+    def __init__(self):
+        self._stages = list()
+
+    def add(self, name, func, depends=(), when=None):
+        self._stages.append(Stage(name, func, depends, when))
+
+    def _ready(self, stage, results, errors, skipped, failed):
+        '''returns 'run', 'skip' or 'fail' for a stage whose dependencies
+        are done, None if they are not done yet'''
+
+        if not all(dep in results or dep in errors or dep in skipped or dep in failed
+                   for dep in stage.depends):
+            return None
+
+        if any(dep in skipped for dep in stage.depends):
+            return 'skip'
+
+        try:
+            run_stage = stage.when is None or stage.when(results)
+        except Exception:
+            # needs the result of a stage that failed
+            run_stage = True
+
+        if not run_stage:
+            return 'skip'
+        elif any(dep in errors or dep in failed for dep in stage.depends):
+            return 'fail'
+        else:
+            return 'run'
+
+    def run(self):
+        '''runs the stages, returns the dict of their return values'''
+
+        results = dict()
+        errors = dict()
+        skipped = set()
+        failed = set()
+
+        pending = list(self._stages)
+        running = dict()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(pending), 1)) as executor:
+            while pending or running:
+                for stage in list(pending):
+                    state = self._ready(stage, results, errors, skipped, failed)
+
+                    if state is None:
+                        continue
+
+                    pending.remove(stage)
+
+                    if state == 'run':
+                        logging.info('STAGE START: %s', stage.name)
+                        running[executor.submit(stage.func, results)] = stage
+                    elif state == 'skip':
+                        logging.info('STAGE SKIPPED: %s', stage.name)
+                        skipped.add(stage.name)
+                    else:
+                        logging.info('STAGE NOT RUN: %s', stage.name)
+                        failed.add(stage.name)
+
+                if not running:
+                    if pending:
+                        raise ValueError('Unknown stages in the dependencies of {0}'.format(
+                            [stage.name for stage in pending]))
+                    break
+
+                (done, _) = concurrent.futures.wait(running,
+                                                    return_when=concurrent.futures.FIRST_COMPLETED)
+
+                for future in done:
+                    stage = running.pop(future)
+                    try:
+                        results[stage.name] = future.result()
+                        logging.info('STAGE DONE: %s', stage.name)
+                    except BaseException as err:
+                        logging.exception(err)
+                        errors[stage.name] = err
+
+        for stage in self._stages:
+            if stage.name in errors:
+                dependents = [dep_stage.name for dep_stage in self._stages
+                              if stage.name in dep_stage.depends]
+
+                if not dependents or any(name in failed for name in dependents):
+                    raise errors[stage.name]
+
+        return results
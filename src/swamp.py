@@ -8,6 +8,7 @@ from .logger import LogTaskStatus
 from . import confreader
 from . import install_os_dependencies
 from . import results_parser
+from . import stages
 from . import utillib
 
 
@@ -15,7 +16,13 @@ def main(input_dir,
          output_dir,
          build_dir,
          tool_dir,
-         results_dir):
+         results_dir,
+         jobs=None,
+         swatool=None,
+         parser_exe_file=None):
+    '''runs the goal in run.conf, returns the exit code. swatool and
+    parser_exe_file are a tool and a result parser already set up, by
+    batch mode, for packages with the same tool.conf and resultparser.conf'''
 
     with LogTaskStatus('all') as status_dot_out:
         try:
@@ -45,19 +52,24 @@ def main(input_dir,
                 raise ValueError('Unknown goal {0}, it should be one of {1}'.format(goal,
                                                                                     swamp_goals))
 
-            install_os_dependencies.install(input_dir)
+            jobs = _get_jobs(jobs, param)
+            logging.info('JOBS: %d', jobs)
 
-            if goal in swamp_goals[:3]:
+            if goal in swamp_goals[:5]:
+                # installs the os dependencies first
                 exit_code = _build_assess_parse(goal,
                                                 input_dir,
                                                 output_dir,
                                                 build_dir,
                                                 tool_dir,
-                                                results_dir)
-            elif goal in swamp_goals[3:5]:
-                raise NotImplementedError
-            elif goal == swamp_goals[5]:
-                exit_code = results_parser.just_parse(input_dir, output_dir)
+                                                results_dir,
+                                                jobs,
+                                                swatool,
+                                                parser_exe_file)
+            else:
+                install_os_dependencies.install(input_dir)
+                exit_code = results_parser.just_parse(input_dir, output_dir,
+                                                      parser_exe_file=parser_exe_file)
 
         except (BaseException, Exception) as err:
             logging.exception(err)
@@ -70,27 +82,111 @@ def main(input_dir,
 
     return exit_code
 
-def _build_assess_parse(goal, input_root_dir, output_root_dir,
-                        build_root_dir, tool_root_dir,
-                        results_root_dir):
+def _get_jobs(jobs, run_conf):
+    '''command line takes precedence over run.conf, default is number of CPUs'''
+
+    if jobs is None and run_conf.get('jobs'):
+        try:
+            jobs = int(run_conf['jobs'])
+        except ValueError:
+            logging.warning("Invalid jobs '%s' in run.conf", run_conf['jobs'])
 
-    (exit_code, build_summary_file) = build_ruby.build(input_root_dir,
-                                                       output_root_dir,
-                                                       build_root_dir)
+    if jobs is None or jobs < 1:
+        jobs = utillib.cpu_count()
 
-    if (exit_code == 0) and ('assess' in goal):
+    return jobs
 
-        build_summary_file = osp.join(build_root_dir, build_summary_file)
-        (exit_code, assessment_summary_file) = assess.assess(input_root_dir,
-                                                             output_root_dir,
-                                                             tool_root_dir,
-                                                             results_root_dir,
-                                                             build_summary_file)
+def _build_assess_parse(goal, input_root_dir, output_root_dir,
+                        build_root_dir, tool_root_dir,
+                        results_root_dir, jobs=1,
+                        swatool=None, parser_exe_file=None):
+    '''The result parser and the tool do not depend on the build, they are
+    set up while the package is built, except that a tool-install-cmd,
+    which installs gems, runs after the build. Nothing reads build.tar.gz
+    during the run, it is written while the package is assessed'''
+
+    graph = stages.StageGraph()
+
+    graph.add('os-dependencies',
+              lambda results: install_os_dependencies.install(input_root_dir))
+
+    if goal.startswith('build'):
+        graph.add('build',
+                  lambda results: build_ruby.build(input_root_dir,
+                                                   output_root_dir,
+                                                   build_root_dir,
+                                                   background='assess' in goal),
+                  ['os-dependencies'])
+    else:
+        # assess and assess+parse, the package was built by an earlier run
+        graph.add('build',
+                  lambda results: build_ruby.unarchive_build(input_root_dir,
+                                                             build_root_dir),
+                  ['os-dependencies'])
+
+    if 'assess' in goal:
+        if swatool is None and \
+           'tool-install-cmd' in assess.SwaTool.read_tool_conf(input_root_dir):
+            # tool-install-cmd installs gems like the build does, in the
+            # same gem directories, so the tool is unarchived while the
+            # package is built and installed after the build
+            graph.add('tool-unarchive',
+                      lambda results: assess.get_swatool(input_root_dir,
+                                                         output_root_dir,
+                                                         tool_root_dir,
+                                                         install=False))
+
+            graph.add('tool',
+                      lambda results: results['tool-unarchive'].install(),
+                      ['build', 'tool-unarchive'],
+                      when=lambda results: results['build'][0] == 0)
+        else:
+            graph.add('tool',
+                      lambda results: swatool or assess.get_swatool(input_root_dir,
+                                                                    output_root_dir,
+                                                                    tool_root_dir),
+                      ['os-dependencies'])
+
+        graph.add('assess',
+                  lambda results: assess.assess(input_root_dir,
+                                                output_root_dir,
+                                                tool_root_dir,
+                                                results_root_dir,
+                                                osp.join(build_root_dir, results['build'][1]),
+                                                jobs,
+                                                swatool=results['tool']),
+                  ['build', 'tool'],
+                  when=lambda results: results['build'][0] == 0)
+
+    if 'parse' in goal:
+        graph.add('result-parser',
+                  lambda results: parser_exe_file or results_parser.get_results_parser(input_root_dir),
+                  ['os-dependencies'])
+
+        graph.add('parse',
+                  lambda results: results_parser.parse_results(input_root_dir,
+                                                               results['assess'][1],
+                                                               results_root_dir,
+                                                               output_root_dir,
+                                                               parser_exe_file=results['result-parser']),
+                  ['assess', 'result-parser'],
+                  when=lambda results: results['assess'][0] == 0)
+
+    try:
+        results = graph.run()
+    except BaseException:
+        # the exception of the stage is the one raised
+        try:
+            build_ruby.wait_build_archive()
+        except Exception as err:
+            logging.exception(err)
+        raise
 
-        if (exit_code == 0) and ('parse' in goal):
-            exit_code = results_parser.parse_results(input_root_dir,
-                                                     assessment_summary_file,
-                                                     results_root_dir,
-                                                     output_root_dir)
+    build_ruby.wait_build_archive()
 
-    return exit_code
+    if 'parse' in results:
+        return results['parse']
+    elif 'assess' in results:
+        return results['assess'][0]
+    else:
+        return results['build'][0]
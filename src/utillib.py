@@ -8,7 +8,20 @@ import time
 import re
 import shlex
 import uuid
+import hashlib
+import logging
+import io
+import gzip
+import shutil
+import stat
+import tarfile
+import zipfile
+import threading
 import pkgutil
+import concurrent.futures
+import xml.etree.ElementTree as ET
+
+from . import confreader
 
 
 if 'PermissionError' in __builtins__:
@@ -52,27 +65,246 @@ def datetime_iso8601():
 def posix_epoch():
     return str(time.time())
 
-def _unpack_archive_xz(archive, dirpath):
-
-    xz_proc = subprocess.Popen(['xz', '--decompress', '--stdout', archive],
-                               stdout=subprocess.PIPE,
-                               stderr=sys.stderr)
+ARCHIVE_MAGIC = [
+    (b'\x1f\x8b', 'gz'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x1f\x9d', 'Z'),
+    (b'PK\x03\x04', 'zip'),
+    (b'PK\x05\x06', 'zip'),
+]
+
+ARCHIVE_EXTENSIONS = [
+    ('.tar.gz', 'gz'),
+    ('.tgz', 'gz'),
+    ('.tar.Z', 'Z'),
+    ('.tar.bz2', 'bz2'),
+    ('.tar.xz', 'xz'),
+    ('.tar', 'tar'),
+    ('.zip', 'zip'),
+    ('.jar', 'zip'),
+    ('.war', 'zip'),
+    ('.ear', 'zip'),
+]
+
+# multi-threaded decompressors, in order of preference
+DECOMPRESSORS = {
+    'gz': [['pigz', '--decompress', '--stdout']],
+    'bz2': [['lbzip2', '--decompress', '--stdout'],
+            ['pbzip2', '-d', '-c']],
+    'xz': [['xz', '--decompress', '--stdout']],
+    'Z': [['gzip', '--decompress', '--stdout']],
+}
+
+def get_archive_format(archive):
+    '''returns the format of archive: gz, bz2, xz, Z (compressed tar files),
+    tar or zip, from the magic bytes at the start of the file, or from the
+    file extension if they are not known. Returns None if neither is known'''
+
+    with open(archive, 'rb') as fobj:
+        header = fobj.read(512)
+
+    for (magic, fmt) in ARCHIVE_MAGIC:
+        if header.startswith(magic):
+            return fmt
+
+    if header[257:262] == b'ustar':
+        return 'tar'
+
+    for (ext, fmt) in ARCHIVE_EXTENSIONS:
+        if archive.lower().endswith(ext.lower()):
+            return fmt
+
+    return None
+
+def _unpack_archive_pipe(decompress_cmd, archive, dirpath):
+
+    decompress_proc = subprocess.Popen(decompress_cmd + [archive],
+                                       stdout=subprocess.PIPE,
+                                       stderr=sys.stderr)
 
     tar_proc = subprocess.Popen(['tar', '-x'],
-                                stdin=xz_proc.stdout,
+                                stdin=decompress_proc.stdout,
                                 stdout=sys.stdout,
                                 stderr=sys.stderr,
                                 cwd=dirpath)
 
-    xz_proc.stdout.close()
+    decompress_proc.stdout.close()
     tar_proc.communicate()
 
+    if decompress_proc.wait() != 0:
+        return decompress_proc.returncode
+
     return tar_proc.returncode
 
-def unpack_archive(archive, dirpath, createdir=True):
+def _is_inside(name):
+    '''true if the relative path name stays inside the directory it is
+    relative to, tar -x refuses the archive members that do not'''
+    return not osp.isabs(name) and '..' not in name.replace('\\', '/').split('/')
+
+def _is_symlink_inside(member):
+    '''true if the target of the symlink member stays inside the directory,
+    the target is relative to the directory of the member'''
+
+    if osp.isabs(member.linkname):
+        return False
+
+    return _is_inside(osp.normpath(osp.join(osp.dirname(member.name), member.linkname)))
+
+def _get_safe_members(tar):
+    '''the members of the tar file that are extracted inside the directory,
+    for the versions of tarfile without extraction filters. Hard links are
+    relative to the archive root, symlinks to the directory of the member'''
+
+    for member in tar:
+        if _is_inside(member.name) and \
+           not (member.issym() and not _is_symlink_inside(member)) and \
+           not (member.islnk() and not _is_inside(member.linkname)):
+            yield member
+        else:
+            logging.warning('Not extracting %s, outside of the directory', member.name)
+
+def _extract_selected(tar, dirpath, select, extract_args):
+    '''extracts the members of the tar file for which select(name)
+    is true, returns the number of members extracted'''
+
+    count = 0
+    members = tar if extract_args.get('filter') else _get_safe_members(tar)
+
+    for member in members:
+        if member.isdir() or not select(member.name):
+            continue
+
+        try:
+            tar.extract(member, dirpath, **extract_args)
+            count += 1
+        except (tarfile.TarError, OSError) as err:
+            # such as a hard link to a member that was not selected
+            logging.warning('Extracting %s: %s', member.name, err)
+
+    return count
+
+def _find_decompressor(fmt):
+    '''returns the command of the first decompressor of fmt in PATH, None if
+    there is none'''
+
+    for decompress_cmd in DECOMPRESSORS.get(fmt, []):
+        if shutil.which(decompress_cmd[0]):
+            if decompress_cmd[0] == 'xz' and _xz_has_threads():
+                return decompress_cmd[:1] + ['--threads=0'] + decompress_cmd[1:]
+            return decompress_cmd
+
+    return None
+
+_xz_threads = None
+
+def _xz_has_threads():
+    '''true if xz accepts --threads, from xz 5.2, centos-6 has xz 4.999'''
+
+    global _xz_threads
+
+    if _xz_threads is None:
+        try:
+            output = subprocess.check_output(['xz', '--version'],
+                                             stderr=subprocess.DEVNULL).decode('utf-8')
+            match = re.search(r'(\d+)\.(\d+)', output)
+            _xz_threads = bool(match) and \
+                          (int(match.group(1)), int(match.group(2))) >= (5, 2)
+        except (OSError, subprocess.CalledProcessError):
+            _xz_threads = False
+
+    return _xz_threads
+
+def _unpack_archive_tarfile(fmt, archive, dirpath, select=None):
+    '''extracts the tar file in process, streaming through the decompressor.
+    With select, only the members for which select(name) is true'''
+
+    extract_args = dict()
+    if hasattr(tarfile, 'tar_filter'):
+        # like tar -x, strips leading slashes and refuses members and links
+        # outside of dirpath, package archives are not trusted
+        extract_args['filter'] = 'tar'
+
+    decompress_proc = None
+    decompress_cmd = _find_decompressor(fmt) if select is not None else None
+    if decompress_cmd:
+        decompress_proc = subprocess.Popen(decompress_cmd + [archive],
+                                           stdout=subprocess.PIPE)
+
+    try:
+        if decompress_proc:
+            tar = tarfile.open(fileobj=decompress_proc.stdout, mode='r|')
+        else:
+            tar = tarfile.open(archive, 'r|' + ('' if fmt == 'tar' else fmt))
+
+        with tar:
+            if select is None and extract_args:
+                tar.extractall(dirpath, **extract_args)
+            elif select is None:
+                tar.extractall(dirpath, members=_get_safe_members(tar))
+            else:
+                count = _extract_selected(tar, dirpath, select, extract_args)
+                logging.info('Extracted %d selected files of %s', count, archive)
+
+        if decompress_proc and decompress_proc.wait() != 0:
+            return decompress_proc.returncode
+
+        return 0
+    except Exception as err:
+        logging.error('Unpacking %s: %s', archive, err)
+        return 1
+    finally:
+        if decompress_proc:
+            decompress_proc.stdout.close()
+            decompress_proc.wait()
+
+def _unpack_archive_zipfile(archive, dirpath, select=None):
+
+    try:
+        with zipfile.ZipFile(archive) as zip_file:
+            for info in zip_file.infolist():
+                if select is not None and (info.is_dir() or
+                                           not select(info.filename)):
+                    continue
+
+                mode = info.external_attr >> 16
+
+                if stat.S_ISLNK(mode):
+                    target = zip_file.read(info).decode('utf-8')
+                    if not _is_inside(info.filename) or not _is_inside(target):
+                        # extract would write through the link
+                        raise ValueError('Link {0} -> {1} outside of {2}'.format(info.filename,
+                                                                                target,
+                                                                                dirpath))
+
+                    linkname = osp.join(dirpath, info.filename)
+                    os.makedirs(osp.dirname(linkname), exist_ok=True)
+                    rmfile(linkname)
+                    os.symlink(target, linkname)
+                else:
+                    filename = zip_file.extract(info, dirpath)
+                    if mode & 0o777 and not info.is_dir():
+                        os.chmod(filename, mode & 0o777)
+        return 0
+    except Exception as err:
+        logging.error('Unpacking %s: %s', archive, err)
+        return 1
+
+def unpack_archive(archive, dirpath, createdir=True, unpack_cache=None, copy=False,
+                   select=None):
     '''
     Unarchives/Extracts the file \'archive\' in the directory \'dirpath\'.
     Expects \'dirpath\' to be already present.
+    The format is detected from the contents of the archive, and from the
+    file extension if that fails. Compressed tar files are decompressed by
+    a multi-threaded decompressor (pigz, lbzip2, pbzip2, xz -T0) if there is
+    one in PATH, otherwise they are extracted in process.
+    With unpack_cache, a cache.DiskCache, the archive is extracted once in
+    the cache entry for its digest and the files are hard linked from there,
+    or copied (reflinked where the file system can) if copy is True, for
+    trees that are modified in place.
+    With select, only the files for which select(name) is true are
+    extracted, in process, and the unpack cache is not used.
     Throws FileNotFoundException and NotADirectoryException if
     archive or dirpath not found
     ValueError if archive format is not supported.
@@ -91,26 +323,245 @@ def unpack_archive(archive, dirpath, createdir=True):
     archive = osp.abspath(archive)
     dirpath = osp.abspath(dirpath)
 
-    if archive.endswith('.tar.gz'):
-        return run_cmd(['tar', '-x', '-z', '-f', archive], cwd=dirpath)[0]
-    elif archive.endswith('.tgz'):
-        return run_cmd(['tar', '-x', '-z', '-f', archive], cwd=dirpath)[0]
-    elif archive.endswith('.tar.Z'):
-        return run_cmd(['tar', '-x', '-Z', '-f', archive], cwd=dirpath)[0]
-    elif archive.endswith('.tar.bz2'):
-        return run_cmd(['tar', '-x', '-j', '-f', archive], cwd=dirpath)[0]
-    elif archive.endswith('.tar'):
+    if select is not None:
+        return _unpack_archive_selected(archive, dirpath, select)
+    elif unpack_cache is not None:
+        return _unpack_archive_cached(unpack_cache, archive, dirpath, copy)
+    else:
+        return _unpack_archive(archive, dirpath)
+
+def _unpack_archive_cached(unpack_cache, archive, dirpath, copy):
+
+    key = file_digest(archive)
+    added = False
+
+    with unpack_cache.lock(key):
+        entry_dir = unpack_cache.get(key)
+
+        if entry_dir is None:
+            exit_codes = list()
+
+            def populate(tmp_dir):
+                exit_codes.append(_unpack_archive(archive, tmp_dir))
+                if exit_codes[-1] != 0:
+                    raise UnpackArchiveError(osp.basename(archive))
+
+            try:
+                entry_dir = unpack_cache.put(key, populate)
+            except UnpackArchiveError:
+                return exit_codes[-1]
+
+            added = True
+            logging.info('UNPACK CACHE: %s unpacked in %s', archive, entry_dir)
+        else:
+            logging.info('UNPACK CACHE: %s found in %s', archive, entry_dir)
+
+        if copy:
+            copy_tree(entry_dir, dirpath)
+        else:
+            link_tree(entry_dir, dirpath)
+
+    if added:
+        unpack_cache.gc()
+
+    return 0
+
+def _unpack_archive_selected(archive, dirpath, select):
+
+    fmt = get_archive_format(archive)
+
+    if fmt == 'zip':
+        return _unpack_archive_zipfile(archive, dirpath, select)
+    elif fmt == 'Z' and not _find_decompressor(fmt):
+        # tarfile cannot read compress files, tar -x -Z extracts everything
+        logging.info('No decompressor for %s, extracting all the files', archive)
+        return _unpack_archive(archive, dirpath)
+    elif fmt == 'tar' or fmt in DECOMPRESSORS:
+        return _unpack_archive_tarfile(fmt, archive, dirpath, select)
+    else:
+        raise ValueError('Format not supported')
+
+def _unpack_archive(archive, dirpath):
+
+    fmt = get_archive_format(archive)
+
+    if fmt == 'zip':
+        if shutil.which('unzip'):
+            return run_cmd(['unzip', '-qq', '-o', archive], cwd=dirpath)[0]
+        else:
+            return _unpack_archive_zipfile(archive, dirpath)
+    elif fmt == 'tar':
         return run_cmd(['tar', '-x', '-f', archive], cwd=dirpath)[0]
-    elif archive.endswith('.tar.xz'):
-        return _unpack_archive_xz(archive, dirpath)
-    elif (osp.splitext(archive)[1].lower() == '.zip') or\
-         (osp.splitext(archive)[1].lower() == '.jar') or\
-         (osp.splitext(archive)[1].lower() == '.war') or\
-         (osp.splitext(archive)[1].lower() == '.ear'):
-        return run_cmd(['unzip', '-qq', '-o', archive], cwd=dirpath)[0]
+    elif fmt in DECOMPRESSORS:
+        decompress_cmd = _find_decompressor(fmt)
+        if decompress_cmd:
+            return _unpack_archive_pipe(decompress_cmd, archive, dirpath)
+
+        if fmt == 'Z':
+            return run_cmd(['tar', '-x', '-Z', '-f', archive], cwd=dirpath)[0]
+        else:
+            return _unpack_archive_tarfile(fmt, archive, dirpath)
     else:
         raise ValueError('Format not supported')
 
+class _HashReader:
+    '''file object wrapper that computes the digest of the data read'''
+
+    def __init__(self, fobj, algorithm='sha256'):
+        self._fobj = fobj
+        self.hash = hashlib.new(algorithm)
+
+    def read(self, size=-1):
+        data = self._fobj.read(size)
+        self.hash.update(data)
+        return data
+
+
+class _GzipWriter:
+    '''Compresses the data written to it in blocks on a pool of threads,
+    each block is a gzip member of its own, which standard gzip readers
+    read as one stream'''
+
+    BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, fobj, level, jobs):
+        self._fobj = fobj
+        self._level = level
+        self._jobs = jobs
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        self._pending = list()
+        self._buf = bytearray()
+        self.hash = hashlib.sha256()
+
+    def _flush_pending(self, max_pending):
+        while len(self._pending) > max_pending:
+            data = self._pending.pop(0).result()
+            self.hash.update(data)
+            self._fobj.write(data)
+
+    @classmethod
+    def _compress(cls, block, level):
+        # gzip.compress has no mtime before Python 3.8, GzipFile has
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level, mtime=0) as gzip_fobj:
+            gzip_fobj.write(block)
+        return buf.getvalue()
+
+    def _submit(self, block):
+        self._pending.append(self._executor.submit(_GzipWriter._compress, block,
+                                                   self._level))
+        self._flush_pending(self._jobs * 2)
+
+    def write(self, data):
+        self._buf += data
+        while len(self._buf) >= _GzipWriter.BLOCK_SIZE:
+            self._submit(bytes(self._buf[:_GzipWriter.BLOCK_SIZE]))
+            del self._buf[:_GzipWriter.BLOCK_SIZE]
+        return len(data)
+
+    def close(self):
+        if self._buf or not self._pending:
+            self._submit(bytes(self._buf))
+            self._buf = bytearray()
+        self._flush_pending(0)
+        self._executor.shutdown()
+
+
+class _PigzWriter:
+    '''Compresses the data written to it with pigz'''
+
+    def __init__(self, fobj, level, jobs):
+        self._fobj = fobj
+        self.hash = hashlib.sha256()
+        self._proc = subprocess.Popen(['pigz', '--stdout', '-{0}'.format(level),
+                                       '--processes', str(jobs)],
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE)
+        self._reader = threading.Thread(target=self._copy_output)
+        self._reader.start()
+
+    def _copy_output(self):
+        for data in iter(lambda: self._proc.stdout.read(1024 * 1024), b''):
+            self.hash.update(data)
+            self._fobj.write(data)
+
+    def write(self, data):
+        return self._proc.stdin.write(data)
+
+    def close(self):
+        self._proc.stdin.close()
+        self._reader.join()
+        if self._proc.wait() != 0:
+            raise OSError('pigz exit code {0}'.format(self._proc.returncode))
+
+
+def make_archive(base_name, root_dir, base_dir, level=6, jobs=None):
+    '''
+    Creates the gzip\'ed tar file base_name.tar.gz of the directory
+    base_dir in root_dir, like shutil.make_archive(base_name, \'gztar\', ...).
+    Compression runs on jobs threads (default: number of CPUs) with pigz
+    if it is in PATH. While archiving, writes base_name.tar.gz.sha256
+    with the sha256 digest of each file in the archive and of the archive
+    itself, in the format of sha256sum.
+    Returns the name of the archive.
+    '''
+
+    if jobs is None:
+        jobs = cpu_count()
+
+    archive = base_name + '.tar.gz'
+    manifest = list()
+
+    def add(tar, path, arcname):
+        tarinfo = tar.gettarinfo(path, arcname)
+        if tarinfo is None:
+            return
+
+        if tarinfo.isreg():
+            with open(path, 'rb') as fobj:
+                reader = _HashReader(fobj)
+                tar.addfile(tarinfo, reader)
+            manifest.append((reader.hash.hexdigest(), arcname))
+        else:
+            tar.addfile(tarinfo)
+
+        if tarinfo.isdir():
+            for name in sorted(os.listdir(path)):
+                add(tar, osp.join(path, name), osp.join(arcname, name))
+
+    with open(archive, 'wb') as fobj:
+        if shutil.which('pigz'):
+            writer = _PigzWriter(fobj, level, jobs)
+        else:
+            writer = _GzipWriter(fobj, level, jobs)
+
+        try:
+            with tarfile.open(fileobj=writer, mode='w|') as tar:
+                add(tar, osp.join(root_dir, base_dir), base_dir)
+        finally:
+            writer.close()
+
+    manifest.append((writer.hash.hexdigest(), osp.basename(archive)))
+
+    with open(archive + '.sha256', 'w') as fobj:
+        for (digest, filename) in manifest:
+            fobj.write('{0}  {1}\n'.format(digest, filename))
+
+    return archive
+
+def get_run_conf(input_dir):
+    '''returns the run.conf in input_dir as a dict, empty if there is none'''
+
+    run_conf_file = osp.join(input_dir, 'run.conf')
+    if osp.isfile(run_conf_file):
+        return confreader.read_conf_into_dict(run_conf_file)
+    else:
+        return dict()
+
+def get_archive_level(run_conf):
+    '''gzip compression level of the output archives from run.conf'''
+    return int(run_conf.get('archive-compression-level', 6))
+
 def run_cmd(cmd,
             outfile=sys.stdout,
             errfile=sys.stderr,
@@ -168,6 +619,37 @@ def get_cpu_type():
     except subprocess.CalledProcessError:
         return None
 
+def cpu_count():
+    'number of CPUs this process is allowed to run on'
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    else:
+        return os.cpu_count() or 1
+
+def parallel_map(func, items, jobs, weight=None):
+    '''Calls func on every item in items using a pool of jobs threads.
+    Items with the largest weight are started first, results are
+    yielded in the order of items'''
+
+    items = list(items)
+
+    if jobs <= 1 or len(items) <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    order = list(range(len(items)))
+    if weight:
+        order.sort(key=lambda idx: weight(items[idx]), reverse=True)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [None] * len(items)
+        for idx in order:
+            futures[idx] = executor.submit(func, items[idx])
+
+        for future in futures:
+            yield future.result()
+
 def max_cmd_size():
 
     #expr `getconf ARG_MAX` - `env|wc -c` - `env|wc -l` \* 4 - 2048
@@ -180,6 +662,32 @@ def max_cmd_size():
     arg_max = arg_max - env_len - env_num * 4 - 2048 # extra caution
     return arg_max
 
+def split_args(items, max_size, max_count=None, key=str):
+    '''Splits items into lists such that the command line arguments,
+    key(item) for each item, of a list fit in max_size bytes and a list
+    has at most max_count items'''
+
+    chunks = list()
+    chunk = list()
+    chunk_size = 0
+
+    for item in items:
+        arg_size = len(key(item).encode('utf-8')) + 1
+
+        if chunk and ((chunk_size + arg_size > max_size) or \
+                      (max_count and len(chunk) >= max_count)):
+            chunks.append(chunk)
+            chunk = list()
+            chunk_size = 0
+
+        chunk.append(item)
+        chunk_size += arg_size
+
+    if chunk:
+        chunks.append(chunk)
+
+    return chunks
+
 def platform():
     if 'VMPLATNAME' in os.environ:
         return os.environ['VMPLATNAME']
@@ -306,30 +814,403 @@ def quote_str(s):
     else:
         return _quote(s)
 
+def get_cache_dir(*subdirs):
+    '''Directory for data kept between runs on this host, set with
+    RUBY_ASSESS_CACHE_DIR, default ~/.cache/ruby-assess'''
+
+    cache_dir = os.getenv('RUBY_ASSESS_CACHE_DIR',
+                          osp.join(osp.expanduser('~'), '.cache', 'ruby-assess'))
+    cache_dir = osp.join(cache_dir, *subdirs)
+
+    if not osp.isdir(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+
+    return cache_dir
+
+def get_tree_size(dirpath):
+    '''total size in bytes of the files in dirpath'''
+
+    size = 0
+    for root, _, filenames in os.walk(dirpath):
+        for filename in filenames:
+            filepath = osp.join(root, filename)
+            if not osp.islink(filepath):
+                size += osp.getsize(filepath)
+    return size
+
+def _link_or_copy(src, dest):
+    if osp.lexists(dest):
+        os.remove(dest)
+
+    if osp.islink(src):
+        os.symlink(os.readlink(src), dest)
+    else:
+        try:
+            os.link(src, dest)
+        except OSError:
+            shutil.copy2(src, dest)
+
+def _copy_files(src_dir, dest_dir, copy_function):
+    '''copies the tree src_dir into dest_dir with copy_function(src, dest)
+    for each file, symlinks are copied as symlinks. shutil.copytree into an
+    existing directory (dirs_exist_ok) is from Python 3.8'''
+
+    for (dirpath, dirnames, filenames) in os.walk(src_dir):
+        dest_path = osp.join(dest_dir, osp.relpath(dirpath, src_dir))
+        os.makedirs(dest_path, exist_ok=True)
+
+        for name in filenames + [name for name in dirnames
+                                 if osp.islink(osp.join(dirpath, name))]:
+            src = osp.join(dirpath, name)
+            dest = osp.join(dest_path, name)
+
+            if osp.islink(src):
+                _link_or_copy(src, dest)
+            else:
+                copy_function(src, dest)
+
+def _copy(src, dest):
+    if osp.lexists(dest):
+        os.remove(dest)
+
+    shutil.copy2(src, dest)
+
+def link_tree(src_dir, dest_dir):
+    '''copies the tree src_dir into dest_dir, files are hard linked if
+    possible, copied otherwise; files already in dest_dir are replaced'''
+
+    _copy_files(src_dir, dest_dir, _link_or_copy)
+
+def copy_tree(src_dir, dest_dir):
+    '''copies the tree src_dir into dest_dir, with cp --reflink=auto if
+    available, so that the copies share the blocks of the files on file
+    systems that support it'''
+
+    if shutil.which('cp') and sys.platform.startswith('linux'):
+        exit_code = run_cmd(['cp', '-a', '--reflink=auto',
+                             osp.join(src_dir, '.'), dest_dir])[0]
+        if exit_code == 0:
+            return
+
+    _copy_files(src_dir, dest_dir, _copy)
+
+def file_digest(filename, algorithm='sha256'):
+    digest = hashlib.new(algorithm)
+
+    with open(filename, 'rb') as fobj:
+        for block in iter(lambda: fobj.read(1024 * 1024), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+def string_digest(string, algorithm='sha256'):
+    return hashlib.new(algorithm, string.encode('utf-8')).hexdigest()
+
+def tree_digest(path, jobs=1):
+    '''digest of the relative paths and the contents of the files in the
+    tree path, or of the file path, an empty digest if it does not exist'''
+
+    if osp.isfile(path):
+        return file_digest(path)
+
+    files = list()
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        dirnames.sort()
+        files.extend(osp.join(dirpath, name) for name in sorted(filenames)
+                     if osp.isfile(osp.join(dirpath, name)))
+
+    return string_digest('\n'.join('{0}:{1}'.format(osp.relpath(_file, path), digest)
+                                    for (_file, digest) in zip(files,
+                                                               parallel_map(file_digest,
+                                                                            files, jobs))))
+
+def copy_replace(src_file, dest_file, old, new):
+    '''copies src_file to dest_file replacing the string old with new'''
+
+    with open(src_file, 'rb') as fobj:
+        data = fobj.read()
+
+    with open(dest_file, 'wb') as fobj:
+        fobj.write(data.replace(old.encode('utf-8'), new.encode('utf-8')))
+
+def string_to_size(size_str):
+    '''converts 512, 100K, 10M, 2G to bytes'''
+
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    size_str = size_str.strip().upper().rstrip('B')
+
+    if size_str and size_str[-1] in units:
+        return int(float(size_str[:-1]) * units[size_str[-1]])
+    else:
+        return int(size_str)
+
+class EnvironmentTable:
+    '''Environments of the commands in a summary file. With the shared
+    layout each distinct environment is written once in an <environments>
+    element and commands refer to it by id, with the inline layout every
+    command has its own copy of the environment'''
+
+    SHARED = 'shared'
+    INLINE = 'inline'
+
+    def __init__(self, layout=INLINE):
+        self._layout = layout
+        self._env_ids = dict()
+        self._env_list = list()
+
+    def add(self, parent, environ):
+        '''adds the <environment> element of environ to parent'''
+
+        env_elem = ET.SubElement(parent, 'environment')
+
+        if self._layout == EnvironmentTable.INLINE:
+            EnvironmentTable._add_env(env_elem, environ)
+        else:
+            key = tuple(sorted(environ.items()))
+
+            if key not in self._env_ids:
+                self._env_ids[key] = 'env{0}'.format(len(self._env_ids) + 1)
+                self._env_list.append((self._env_ids[key], dict(environ)))
+
+            env_elem.set('ref', self._env_ids[key])
+
+        return env_elem
+
+    @classmethod
+    def _add_env(cls, env_elem, environ):
+        for key in environ.keys():
+            elem = ET.SubElement(env_elem, 'env')
+            elem.text = '{0}={1}'.format(key, environ[key])
+
+    def get_environments(self):
+        '''returns the <environments> element, None with the inline layout
+        or if no environment was added'''
+
+        if self._layout == EnvironmentTable.INLINE or not self._env_list:
+            return None
+
+        envs_elem = ET.Element('environments')
+        for (env_id, environ) in self._env_list:
+            env_elem = ET.SubElement(envs_elem, 'environment')
+            env_elem.set('id', env_id)
+            EnvironmentTable._add_env(env_elem, environ)
+
+        return envs_elem
+
+
 def get_uuid():
     return str(uuid.uuid4())
 
-def os_walk(root_dir, exclude):
+def _make_prefix_trie(paths):
+    '''nested dicts of the path components of paths, the key None marks
+    the end of a path'''
+
+    trie = dict()
+    for path in paths:
+        node = trie
+        for name in osp.normpath(path).split(os.sep):
+            node = node.setdefault(name, dict())
+        node[None] = True
+    return trie
+
+def _glob_to_regex(pattern):
+    '''translates a glob pattern to a regular expression, * and ? do not
+    match /, ** matches across directories'''
+
+    regex = ''
+    idx = 0
+
+    while idx < len(pattern):
+        if pattern.startswith('**/', idx):
+            regex += '(?:.*/)?'
+            idx += 3
+        elif pattern.startswith('**', idx):
+            regex += '.*'
+            idx += 2
+        elif pattern[idx] == '*':
+            regex += '[^/]*'
+            idx += 1
+        elif pattern[idx] == '?':
+            regex += '[^/]'
+            idx += 1
+        elif pattern[idx] == '[' and pattern.find(']', idx + 2) != -1:
+            end = pattern.find(']', idx + 2)
+            chars = pattern[idx + 1:end]
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            regex += '[' + chars.replace('\\', '\\\\') + ']'
+            idx = end + 1
+        else:
+            regex += re.escape(pattern[idx])
+            idx += 1
+
+    return regex
+
+class PathMatcher:
+    '''Matches paths relative to a directory against a list of exclude
+    patterns in the style of .gitignore:
+        lib/foo.rb      a path without wildcards, relative to the directory
+        *.min.js        a pattern without a slash, matches at any depth
+        spec/**/data    ** matches any number of directories
+        tmp/            matches directories only
+        !vendor/mine    includes paths excluded by an earlier pattern
+    A pattern matches a path and everything below it, the last pattern
+    that matches a path decides if it is excluded'''
+
+    GLOB_CHARS = re.compile(r'[*?[]')
+
+    def __init__(self, patterns):
+        self.patterns = list()
+
+        for pattern in patterns:
+            pattern = pattern.strip()
+            negate = pattern.startswith('!')
+            if negate:
+                pattern = pattern[1:]
+
+            dir_only = pattern.endswith('/')
+            is_glob = PathMatcher.GLOB_CHARS.search(pattern) is not None
+            anchored = not is_glob or '/' in pattern.strip('/') or pattern.startswith('/')
+
+            pattern = pattern.strip('/')
+            if not is_glob:
+                pattern = osp.normpath(pattern).replace(os.sep, '/')
+            if not pattern or pattern == '.':
+                continue
+
+            regex = ('' if anchored else '(?:.*/)?') + _glob_to_regex(pattern)
+            self.patterns.append({
+                'pattern': pattern,
+                'negate': negate,
+                'dir-only': dir_only,
+                'anchored': anchored,
+                'is-glob': is_glob,
+                'full': re.compile('^' + regex + '$'),
+                'below': re.compile('^' + regex + '/'),
+            })
+
+        self._negations = [pat for pat in self.patterns if pat['negate']]
+
+    def __bool__(self):
+        return bool(self.patterns)
+
+    def get_literals(self):
+        '''the paths without wildcards that are excluded'''
+        return [pat['pattern'] for pat in self.patterns
+                if not pat['is-glob'] and not pat['negate']]
+
+    @classmethod
+    def _matches(cls, pat, path, is_dir):
+        return (pat['full'].match(path) and (is_dir or not pat['dir-only'])) or \
+            pat['below'].match(path)
+
+    def match(self, path, is_dir=False):
+        '''returns True if path, relative to the directory, is excluded'''
+
+        path = path.replace(os.sep, '/')
+        excluded = False
+
+        for pat in self.patterns:
+            if PathMatcher._matches(pat, path, is_dir):
+                excluded = not pat['negate']
+
+        return excluded
+
+    def _may_include_below(self, path):
+        '''True if a negated pattern may match a path below the directory'''
+
+        names = path.split('/')
+
+        for pat in self._negations:
+            if not pat['anchored']:
+                return True
+
+            pat_names = pat['pattern'].split('/')
+            for (idx, name) in enumerate(names):
+                if idx >= len(pat_names) or pat_names[idx] == '**':
+                    return True
+                if not re.match('^' + _glob_to_regex(pat_names[idx]) + '$', name):
+                    break
+            else:
+                return True
+
+        return False
 
-    if not osp.exists(root_dir) and osp.isfile(root_dir):
+    def prunes(self, path):
+        '''returns True if the directory path and everything below it is
+        excluded, the directory does not need to be walked'''
+
+        path = path.replace(os.sep, '/')
+        return self.match(path, True) and not self._may_include_below(path)
+
+    def prunes_parent(self, path):
+        '''returns the first parent directory of path that is pruned, None
+        if there is none'''
+
+        names = path.replace(os.sep, '/').split('/')
+        for idx in range(1, len(names)):
+            parent = '/'.join(names[:idx])
+            if self.prunes(parent):
+                return parent
+
+        return None
+
+def os_walk(root_dir, exclude, matcher=None):
+    '''
+    Like os.walk, yields (dirpath, None, filenames) for root_dir and its
+    subdirectories, except for the directories in exclude, the directories
+    matcher, a PathMatcher of paths relative to root_dir, prunes, hidden
+    directories and everything below them. Hidden files are left out of
+    filenames. Directories are visited in sorted order, filenames are
+    sorted. Excluded and hidden directories are not descended into.
+    '''
+
+    if not osp.isdir(root_dir):
         return
 
-    def is_path_in(dirpath, _list):
-        if _list:
-            _list = {osp.join(osp.normpath(dirpath), '') for dirpath in _list}
-            return any((True if dirpath.startswith(path) else False \
-                        for path in _list))
-        else:
-            return False
+    node = _make_prefix_trie(exclude) if exclude else dict()
+    for name in osp.normpath(root_dir).split(os.sep):
+        if node is not None:
+            node = node.get(name)
+        if node is not None and None in node:
+            return
 
-    hidden = []
-    
-    for dirpath, _, filenames in os.walk(root_dir):
-        if osp.basename(dirpath).startswith('.'):
-            hidden.append(dirpath)
-        elif not (is_path_in(osp.join(dirpath, ''), exclude) or \
-                  is_path_in(osp.join(dirpath, ''), hidden)):
-            yield dirpath, None, [_file for _file in filenames if not _file.startswith('.')]
+    if osp.basename(osp.normpath(root_dir)).startswith('.'):
+        return
+
+    stack = [(root_dir, node, '')]
+
+    while stack:
+        (dirpath, node, relpath) = stack.pop()
+
+        try:
+            with os.scandir(dirpath) as entries:
+                entries = sorted(entries, key=lambda entry: entry.name)
+        except OSError:
+            continue
+
+        filenames = list()
+        subdirs = list()
+
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+
+            if not is_dir:
+                if not entry.name.startswith('.'):
+                    filenames.append(entry.name)
+            elif not entry.name.startswith('.') and not entry.is_symlink():
+                subnode = node.get(entry.name) if node else None
+                subpath = relpath + '/' + entry.name if relpath else entry.name
+                if (subnode is None or None not in subnode) and \
+                   not (matcher and matcher.prunes(subpath)):
+                    subdirs.append((entry.path, subnode, subpath))
+
+        yield dirpath, None, filenames
+
+        stack.extend(reversed(subdirs))
 
 def ordered_list(_list):
 
@@ -0,0 +1,125 @@
+#! /usr/bin/env python3
+
+'''
+Times utillib.os_walk, used to find the ruby files of no-build and bundler
+packages, on a synthetic package tree against the os.walk based
+implementation it replaced, and checks that both find the same files.
+
+    util/bench_os_walk.py [--files 200000] [--tree-dir DIR]
+'''
+
+import argparse
+import importlib.util
+import os
+import os.path as osp
+import shutil
+import sys
+import tempfile
+import time
+
+
+def load_utillib():
+    src_dir = osp.join(osp.dirname(osp.dirname(osp.abspath(__file__))), 'src')
+    spec = importlib.util.spec_from_file_location('ruby_assess',
+                                                  osp.join(src_dir, '__init__.py'),
+                                                  submodule_search_locations=[src_dir])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['ruby_assess'] = module
+    spec.loader.exec_module(module)
+    return importlib.import_module('ruby_assess.utillib')
+
+
+def os_walk_old(root_dir, exclude):
+
+    def is_path_in(dirpath, _list):
+        if _list:
+            _list = {osp.join(osp.normpath(dirpath), '') for dirpath in _list}
+            return any((True if dirpath.startswith(path) else False \
+                        for path in _list))
+        else:
+            return False
+
+    hidden = []
+
+    for dirpath, _, filenames in os.walk(root_dir):
+        if osp.basename(dirpath).startswith('.'):
+            hidden.append(dirpath)
+        elif not (is_path_in(osp.join(dirpath, ''), exclude) or \
+                  is_path_in(osp.join(dirpath, ''), hidden)):
+            yield dirpath, None, [_file for _file in filenames if not _file.startswith('.')]
+
+
+def make_tree(root_dir, nfiles):
+    '''lib/, spec/, vendor/bundle/ and hidden directories, 10 files per
+    directory, 10 subdirectories per directory'''
+
+    top_dirs = ['lib', 'spec', 'vendor/bundle', '.git', '.bundle', 'test']
+    nfiles_per_top = nfiles // len(top_dirs)
+
+    for top_dir in top_dirs:
+        count = 0
+        queue = [osp.join(root_dir, top_dir)]
+
+        while count < nfiles_per_top:
+            dirpath = queue.pop(0)
+            os.makedirs(dirpath, exist_ok=True)
+
+            for i in range(10):
+                with open(osp.join(dirpath, 'f{0}.rb'.format(i)), 'w') as fobj:
+                    fobj.write('# f{0}\n'.format(i))
+            with open(osp.join(dirpath, '.hidden.rb'), 'w'):
+                pass
+            count += 10
+
+            queue.extend(osp.join(dirpath, 'd{0}'.format(i)) for i in range(10))
+            if (count // 10) % 50 == 0:
+                queue.append(osp.join(dirpath, '.cache'))
+
+
+def time_walk(walk, root_dir, exclude):
+    start = time.time()
+    files = {osp.join(dirpath, filename)
+             for (dirpath, _, filenames) in walk(root_dir, exclude)
+             for filename in filenames}
+    return (time.time() - start, files)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark utillib.os_walk')
+    parser.add_argument('--files', type=int, default=200000,
+                        help='number of files in the synthetic tree')
+    parser.add_argument('--tree-dir', default=None,
+                        help='directory of the synthetic tree, kept if given')
+    args = parser.parse_args()
+
+    utillib = load_utillib()
+
+    tree_dir = args.tree_dir or tempfile.mkdtemp(prefix='bench_os_walk.')
+    pkg_dir = osp.join(tree_dir, 'pkg')
+
+    try:
+        if not osp.isdir(pkg_dir):
+            start = time.time()
+            make_tree(pkg_dir, args.files)
+            print('created {0} files in {1:.2f}s'.format(args.files, time.time() - start))
+
+        exclude = [osp.join(pkg_dir, path) for path in ['vendor/bundle', 'spec/d1', 'test']]
+
+        (old_time, old_files) = time_walk(os_walk_old, pkg_dir, exclude)
+        (new_time, new_files) = time_walk(utillib.os_walk, pkg_dir, exclude)
+
+        print('os.walk:   {0:8.3f}s {1} files'.format(old_time, len(old_files)))
+        print('os_walk:   {0:8.3f}s {1} files'.format(new_time, len(new_files)))
+
+        if old_files != new_files:
+            print('MISMATCH: {0} files differ'.format(len(old_files ^ new_files)))
+            return 1
+    finally:
+        if not args.tree_dir:
+            shutil.rmtree(tree_dir)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())